@@ -1 +1 @@
-from .commands import dainstall, dacreate, dadownload, dauninstall
+from .commands import dainstall, dacreate, dadownload, dauninstall, dastats
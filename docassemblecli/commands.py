@@ -15,35 +15,178 @@ import tomli
 import tomli_w
 from packaging import version as packaging_version
 from watchdog.observers import Observer
-from watchdog.events import RegexMatchingEventHandler
+from watchdog.events import FileSystemEventHandler, FileCreatedEvent, FileDeletedEvent, DirCreatedEvent, DirDeletedEvent
 import asyncio
 import signal
 import hashlib
+import json
+import math
+import collections
+import contextlib
+import concurrent.futures
+import multiprocessing
+import threading
+import binascii
+import sqlite3
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+    import ctypes
+import socket
+import configparser
+import posixpath
 from pathlib import Path
 
 IGNORE_REGEXES = ['.*/\.git$', '.*/\.git/.*', '.*~$', '.*/\.?\#.*', '.*/\.?flycheck_.*', '.*__pycache__.*', '.*/\.mypy_cache/.*', '.*\.egg-info.*', '.*\.py[cod]$', '.*\$py\.class$', '.*\.swp$', '.*/build/.*', '.*\.tmp$', '.*\#$', '.*/\.~.*', '.*/~.*', '.*\.swx$', '.*\.tmp\..*']
 IGNORE_DIRS = ['.git', '__pycache__', '.mypy_cache', '.venv', '.history', 'build']
+STORED_EXTENSIONS = ['.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub', '.pdf', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp3', '.m4a', '.ogg', '.mp4', '.m4v', '.mov', '.webm', '.avi', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.woff', '.woff2']
+COMPRESSED_MAGIC_NUMBERS = [b'PK\x03\x04', b'%PDF', b'\x89PNG', b'\xff\xd8\xff', b'GIF87a', b'GIF89a', b'\x1f\x8b', b'BZh', b'\xfd7zXZ', b'7z\xbc\xaf', b'OggS', b'ID3', b'wOFF', b'wOF2', b'\x1aE\xdf\xa3']
+INSTALL_IGNORE_FILE = '.dainstallignore'
+UPLOAD_TIMEOUT = 50  # Seconds allowed for an upload regardless of its size.
+UPLOAD_MIN_THROUGHPUT = 50 * 1024  # Slowest uplink, in bytes per second, that uploads should tolerate; the timeout grows with the payload size accordingly.
+UPLOAD_RETRIES = 4
+UPLOAD_BACKOFF = 2  # Seconds before the first retry; doubled for each subsequent retry.
+UPLOAD_RETRY_STATUS_CODES = (502, 503, 504)
+UPLOAD_CHUNK_SIZE = 65536
+UPLOAD_PROGRESS_DELAY = 1.0  # Only show progress for uploads that take longer than this many seconds.
+UPLOAD_PROGRESS_INTERVAL = 0.5
+UPLOAD_PROGRESS_INTERVAL_NOTTY = 10.0
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_WORKERS = 4
+CHECKSUM_CACHE_SIZE = 20000  # Maximum number of files whose checksums are remembered in --watch mode; the least recently used are evicted first.
+CHECKSUM_RACY_WINDOW = 2000000000  # Nanoseconds; see checksum_is_same().
+YAML_CHECK_CACHE_SIZE = 5000  # Maximum number of interview file contents whose --validate results are remembered.
+YAML_CHECK_PROCESS_BYTES = 4 * 1024 * 1024  # Total size of interview files to parse beyond which they are parsed in a pool of worker processes rather than in this process.
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+METRICS_COUNTERS = ['events_received', 'events_ignored', 'events_unchanged', 'events_coalesced', 'rescans', 'batches', 'bulk_batches', 'installs', 'uploads']
+METRICS_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+METRICS_SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 500, 1000, 5000)
+METRICS_HISTOGRAMS = {'batch_events': METRICS_SIZE_BUCKETS, 'batch_changes': METRICS_SIZE_BUCKETS, 'debounce_seconds': METRICS_SECONDS_BUCKETS, 'hash_seconds': METRICS_SECONDS_BUCKETS, 'upload_seconds': METRICS_SECONDS_BUCKETS, 'install_seconds': METRICS_SECONDS_BUCKETS, 'restart_wait_seconds': METRICS_SECONDS_BUCKETS, 'save_to_live_seconds': METRICS_SECONDS_BUCKETS}
+ARCHIVE_REPORT_LIMIT = 10  # Number of files listed under "Largest files" in the --archive-report output.
+GIT_TIMEOUT = 60
+LOCK_POLL_INTERVAL = 1.0  # Seconds between checks of whether another dainstall process has finished installing to the same server.
+RESTART_INTERVAL = 30  # Default minimum number of seconds between restarting installs in --watch mode.
+UPLOAD_LANE_ORDER = ['questions', 'templates', 'sources', 'static', 'modules']  # Order in which --watch --playground sends a batch of changes; modules go last because they need a restart before they take effect.
+UPLOAD_BACKGROUND_SIZE = 1024 * 1024  # Files in data folders that are at least this many bytes are uploaded in the background so that they do not hold back smaller changes.
+BACKGROUND_UPLOADS = 2  # Number of background uploads that may be in flight at the same time.
+SYNC_MANIFEST_FILE = '.dadownload_manifest.json'
+SYNC_WORKERS = 8  # Number of Playground files that dadownload --sync requests at the same time.
+HISTORY_PHASES = ['build', 'lock', 'transfer', 'server']
+HISTORY_COLUMNS = {'started': 'REAL', 'command': 'TEXT', 'server': 'TEXT', 'package': 'TEXT', 'mode': 'TEXT', 'archive_bytes': 'INTEGER', 'files': 'INTEGER', 'build_seconds': 'REAL', 'lock_seconds': 'REAL', 'transfer_seconds': 'REAL', 'server_seconds': 'REAL', 'total_seconds': 'REAL', 'restart': 'INTEGER', 'restart_reason': 'TEXT', 'outcome': 'TEXT', 'error': 'TEXT'}
+HISTORY_TIMEOUT = 10  # Seconds to wait for another process that is writing to the history database.
+STATS_RECENT = 10  # Default number of most recent runs that dastats compares against earlier runs.
+STATS_REGRESSION = 0.2  # Fractional increase in median duration that dastats reports as a regression.
 SETTLE_DELAY = 0.6  # Delay in seconds to let the local system become settled after an event. The optimal value depends on how local applications modify files.
+EVENT_STORM_COUNT = 200  # Number of events within EVENT_STORM_WINDOW seconds that indicates a bulk operation, such as a git checkout, rather than editing.
+EVENT_STORM_WINDOW = 1.0
+EVENT_INTAKE_INTERVAL = 0.05  # Seconds during which file system events are collected in the watchdog thread before they are handed to the event loop together.
+EVENT_PENDING_LIMIT = 5000  # Number of changed paths collected in the watchdog thread beyond which the changes are no longer tracked individually and the package is rescanned instead.
+EVENT_QUEUE_SIZE = 10000  # Maximum number of changed paths waiting to be handled in --watch mode; see EventIntake.
+EVENT_STORM_QUIET = 1.0  # Seconds without events after which a bulk operation is considered finished.
+GIT_QUIET = 1.0  # Seconds that must pass after git last changed HEAD, a branch, or the index before a bulk change is installed.
+GIT_PAUSE_LIMIT = 300  # Longest time in seconds to hold back changes while git holds index.lock or HEAD.lock.
+TRACE_VERSION = 1
+REPLAY_IDLE_GAP = 2.0  # Longest pause in seconds between replayed events while nothing is pending; longer pauses in the trace are skipped.
+REPLAY_REQUEST_SECONDS = 0.1  # Simulated round trip of a request to the server when replaying a trace.
+REPLAY_THROUGHPUT = 1024 * 1024  # Simulated upload speed in bytes per second when replaying a trace.
+REPLAY_INSTALL_SECONDS = 3.0  # Simulated time for the server to install the whole package when replaying a trace.
+REPLAY_RESTART_SECONDS = 5.0  # Simulated time for the server to restart when replaying a trace.
 LICENSES = ['0BSD', '3D-Slicer-1.0', 'AAL', 'Abstyles', 'AdaCore-doc', 'Adobe-2006', 'Adobe-Display-PostScript', 'Adobe-Glyph', 'Adobe-Utopia', 'ADSL', 'AFL-1.1', 'AFL-1.2', 'AFL-2.0', 'AFL-2.1', 'AFL-3.0', 'Afmparse', 'AGPL-1.0', 'AGPL-1.0-only', 'AGPL-1.0-or-later', 'AGPL-3.0', 'AGPL-3.0-only', 'AGPL-3.0-or-later', 'Aladdin', 'AMD-newlib', 'AMDPLPA', 'AML', 'AML-glslang', 'AMPAS', 'ANTLR-PD', 'ANTLR-PD-fallback', 'any-OSI', 'any-OSI-perl-modules', 'Apache-1.0', 'Apache-1.1', 'Apache-2.0', 'APAFML', 'APL-1.0', 'App-s2p', 'APSL-1.0', 'APSL-1.1', 'APSL-1.2', 'APSL-2.0', 'Arphic-1999', 'Artistic-1.0', 'Artistic-1.0-cl8', 'Artistic-1.0-Perl', 'Artistic-2.0', 'ASWF-Digital-Assets-1.0', 'ASWF-Digital-Assets-1.1', 'Baekmuk', 'Bahyph', 'Barr', 'bcrypt-Solar-Designer', 'Beerware', 'Bitstream-Charter', 'Bitstream-Vera', 'BitTorrent-1.0', 'BitTorrent-1.1', 'blessing', 'BlueOak-1.0.0', 'Boehm-GC', 'Boehm-GC-without-fee', 'Borceux', 'Brian-Gladman-2-Clause', 'Brian-Gladman-3-Clause', 'BSD-1-Clause', 'BSD-2-Clause', 'BSD-2-Clause-Darwin', 'BSD-2-Clause-first-lines', 'BSD-2-Clause-FreeBSD', 'BSD-2-Clause-NetBSD', 'BSD-2-Clause-Patent', 'BSD-2-Clause-Views', 'BSD-3-Clause', 'BSD-3-Clause-acpica', 'BSD-3-Clause-Attribution', 'BSD-3-Clause-Clear', 'BSD-3-Clause-flex', 'BSD-3-Clause-HP', 'BSD-3-Clause-LBNL', 'BSD-3-Clause-Modification', 'BSD-3-Clause-No-Military-License', 'BSD-3-Clause-No-Nuclear-License', 'BSD-3-Clause-No-Nuclear-License-2014', 'BSD-3-Clause-No-Nuclear-Warranty', 'BSD-3-Clause-Open-MPI', 'BSD-3-Clause-Sun', 'BSD-4-Clause', 'BSD-4-Clause-Shortened', 'BSD-4-Clause-UC', 'BSD-4.3RENO', 'BSD-4.3TAHOE', 'BSD-Advertising-Acknowledgement', 'BSD-Attribution-HPND-disclaimer', 'BSD-Inferno-Nettverk', 'BSD-Protection', 'BSD-Source-beginning-file', 'BSD-Source-Code', 'BSD-Systemics', 'BSD-Systemics-W3Works', 'BSL-1.0', 'BUSL-1.1', 'bzip2-1.0.5', 'bzip2-1.0.6', 'C-UDA-1.0', 'CAL-1.0', 'CAL-1.0-Combined-Work-Exception', 'Caldera', 'Caldera-no-preamble', 'Catharon', 'CATOSL-1.1', 'CC-BY-1.0', 'CC-BY-2.0', 'CC-BY-2.5', 'CC-BY-2.5-AU', 'CC-BY-3.0', 'CC-BY-3.0-AT', 'CC-BY-3.0-AU', 'CC-BY-3.0-DE', 'CC-BY-3.0-IGO', 'CC-BY-3.0-NL', 'CC-BY-3.0-US', 'CC-BY-4.0', 'CC-BY-NC-1.0', 'CC-BY-NC-2.0', 'CC-BY-NC-2.5', 'CC-BY-NC-3.0', 'CC-BY-NC-3.0-DE', 'CC-BY-NC-4.0', 'CC-BY-NC-ND-1.0', 'CC-BY-NC-ND-2.0', 'CC-BY-NC-ND-2.5', 'CC-BY-NC-ND-3.0', 'CC-BY-NC-ND-3.0-DE', 'CC-BY-NC-ND-3.0-IGO', 'CC-BY-NC-ND-4.0', 'CC-BY-NC-SA-1.0', 'CC-BY-NC-SA-2.0', 'CC-BY-NC-SA-2.0-DE', 'CC-BY-NC-SA-2.0-FR', 'CC-BY-NC-SA-2.0-UK', 'CC-BY-NC-SA-2.5', 'CC-BY-NC-SA-3.0', 'CC-BY-NC-SA-3.0-DE', 'CC-BY-NC-SA-3.0-IGO', 'CC-BY-NC-SA-4.0', 'CC-BY-ND-1.0', 'CC-BY-ND-2.0', 'CC-BY-ND-2.5', 'CC-BY-ND-3.0', 'CC-BY-ND-3.0-DE', 'CC-BY-ND-4.0', 'CC-BY-SA-1.0', 'CC-BY-SA-2.0', 'CC-BY-SA-2.0-UK', 'CC-BY-SA-2.1-JP', 'CC-BY-SA-2.5', 'CC-BY-SA-3.0', 'CC-BY-SA-3.0-AT', 'CC-BY-SA-3.0-DE', 'CC-BY-SA-3.0-IGO', 'CC-BY-SA-4.0', 'CC-PDDC', 'CC-PDM-1.0', 'CC-SA-1.0', 'CC0-1.0', 'CDDL-1.0', 'CDDL-1.1', 'CDL-1.0', 'CDLA-Permissive-1.0', 'CDLA-Permissive-2.0', 'CDLA-Sharing-1.0', 'CECILL-1.0', 'CECILL-1.1', 'CECILL-2.0', 'CECILL-2.1', 'CECILL-B', 'CECILL-C', 'CERN-OHL-1.1', 'CERN-OHL-1.2', 'CERN-OHL-P-2.0', 'CERN-OHL-S-2.0', 'CERN-OHL-W-2.0', 'CFITSIO', 'check-cvs', 'checkmk', 'ClArtistic', 'Clips', 'CMU-Mach', 'CMU-Mach-nodoc', 'CNRI-Jython', 'CNRI-Python', 'CNRI-Python-GPL-Compatible', 'COIL-1.0', 'Community-Spec-1.0', 'Condor-1.1', 'copyleft-next-0.3.0', 'copyleft-next-0.3.1', 'Cornell-Lossless-JPEG', 'CPAL-1.0', 'CPL-1.0', 'CPOL-1.02', 'Cronyx', 'Crossword', 'CrystalStacker', 'CUA-OPL-1.0', 'Cube', 'curl', 'cve-tou', 'D-FSL-1.0', 'DEC-3-Clause', 'diffmark', 'DL-DE-BY-2.0', 'DL-DE-ZERO-2.0', 'DOC', 'DocBook-Schema', 'DocBook-Stylesheet', 'DocBook-XML', 'Dotseqn', 'DRL-1.0', 'DRL-1.1', 'DSDP', 'dtoa', 'dvipdfm', 'ECL-1.0', 'ECL-2.0', 'eCos-2.0', 'EFL-1.0', 'EFL-2.0', 'eGenix', 'Elastic-2.0', 'Entessa', 'EPICS', 'EPL-1.0', 'EPL-2.0', 'ErlPL-1.1', 'etalab-2.0', 'EUDatagrid', 'EUPL-1.0', 'EUPL-1.1', 'EUPL-1.2', 'Eurosym', 'Fair', 'FBM', 'FDK-AAC', 'Ferguson-Twofish', 'Frameworx-1.0', 'FreeBSD-DOC', 'FreeImage', 'FSFAP', 'FSFAP-no-warranty-disclaimer', 'FSFUL', 'FSFULLR', 'FSFULLRWD', 'FTL', 'Furuseth', 'fwlw', 'GCR-docs', 'GD', 'generic-xts', 'GFDL-1.1', 'GFDL-1.1-invariants-only', 'GFDL-1.1-invariants-or-later', 'GFDL-1.1-no-invariants-only', 'GFDL-1.1-no-invariants-or-later', 'GFDL-1.1-only', 'GFDL-1.1-or-later', 'GFDL-1.2', 'GFDL-1.2-invariants-only', 'GFDL-1.2-invariants-or-later', 'GFDL-1.2-no-invariants-only', 'GFDL-1.2-no-invariants-or-later', 'GFDL-1.2-only', 'GFDL-1.2-or-later', 'GFDL-1.3', 'GFDL-1.3-invariants-only', 'GFDL-1.3-invariants-or-later', 'GFDL-1.3-no-invariants-only', 'GFDL-1.3-no-invariants-or-later', 'GFDL-1.3-only', 'GFDL-1.3-or-later', 'Giftware', 'GL2PS', 'Glide', 'Glulxe', 'GLWTPL', 'gnuplot', 'GPL-1.0', 'GPL-1.0+', 'GPL-1.0-only', 'GPL-1.0-or-later', 'GPL-2.0', 'GPL-2.0+', 'GPL-2.0-only', 'GPL-2.0-or-later', 'GPL-2.0-with-autoconf-exception', 'GPL-2.0-with-bison-exception', 'GPL-2.0-with-classpath-exception', 'GPL-2.0-with-font-exception', 'GPL-2.0-with-GCC-exception', 'GPL-3.0', 'GPL-3.0+', 'GPL-3.0-only', 'GPL-3.0-or-later', 'GPL-3.0-with-autoconf-exception', 'GPL-3.0-with-GCC-exception', 'Graphics-Gems', 'gSOAP-1.3b', 'gtkbook', 'Gutmann', 'HaskellReport', 'hdparm', 'HIDAPI', 'Hippocratic-2.1', 'HP-1986', 'HP-1989', 'HPND', 'HPND-DEC', 'HPND-doc', 'HPND-doc-sell', 'HPND-export-US', 'HPND-export-US-acknowledgement', 'HPND-export-US-modify', 'HPND-export2-US', 'HPND-Fenneberg-Livingston', 'HPND-INRIA-IMAG', 'HPND-Intel', 'HPND-Kevlin-Henney', 'HPND-Markus-Kuhn', 'HPND-merchantability-variant', 'HPND-MIT-disclaimer', 'HPND-Netrek', 'HPND-Pbmplus', 'HPND-sell-MIT-disclaimer-xserver', 'HPND-sell-regexpr', 'HPND-sell-variant', 'HPND-sell-variant-MIT-disclaimer', 'HPND-sell-variant-MIT-disclaimer-rev', 'HPND-UC', 'HPND-UC-export-US', 'HTMLTIDY', 'IBM-pibs', 'ICU', 'IEC-Code-Components-EULA', 'IJG', 'IJG-short', 'ImageMagick', 'iMatix', 'Imlib2', 'Info-ZIP', 'Inner-Net-2.0', 'InnoSetup', 'Intel', 'Intel-ACPI', 'Interbase-1.0', 'IPA', 'IPL-1.0', 'ISC', 'ISC-Veillard', 'Jam', 'JasPer-2.0', 'JPL-image', 'JPNIC', 'JSON', 'Kastrup', 'Kazlib', 'Knuth-CTAN', 'LAL-1.2', 'LAL-1.3', 'Latex2e', 'Latex2e-translated-notice', 'Leptonica', 'LGPL-2.0', 'LGPL-2.0+', 'LGPL-2.0-only', 'LGPL-2.0-or-later', 'LGPL-2.1', 'LGPL-2.1+', 'LGPL-2.1-only', 'LGPL-2.1-or-later', 'LGPL-3.0', 'LGPL-3.0+', 'LGPL-3.0-only', 'LGPL-3.0-or-later', 'LGPLLR', 'Libpng', 'libpng-2.0', 'libselinux-1.0', 'libtiff', 'libutil-David-Nugent', 'LiLiQ-P-1.1', 'LiLiQ-R-1.1', 'LiLiQ-Rplus-1.1', 'Linux-man-pages-1-para', 'Linux-man-pages-copyleft', 'Linux-man-pages-copyleft-2-para', 'Linux-man-pages-copyleft-var', 'Linux-OpenIB', 'LOOP', 'LPD-document', 'LPL-1.0', 'LPL-1.02', 'LPPL-1.0', 'LPPL-1.1', 'LPPL-1.2', 'LPPL-1.3a', 'LPPL-1.3c', 'lsof', 'Lucida-Bitmap-Fonts', 'LZMA-SDK-9.11-to-9.20', 'LZMA-SDK-9.22', 'Mackerras-3-Clause', 'Mackerras-3-Clause-acknowledgment', 'magaz', 'mailprio', 'MakeIndex', 'Martin-Birgmeier', 'McPhee-slideshow', 'metamail', 'Minpack', 'MIPS', 'MirOS', 'MIT', 'MIT-0', 'MIT-advertising', 'MIT-Click', 'MIT-CMU', 'MIT-enna', 'MIT-feh', 'MIT-Festival', 'MIT-Khronos-old', 'MIT-Modern-Variant', 'MIT-open-group', 'MIT-testregex', 'MIT-Wu', 'MITNFA', 'MMIXware', 'Motosoto', 'MPEG-SSG', 'mpi-permissive', 'mpich2', 'MPL-1.0', 'MPL-1.1', 'MPL-2.0', 'MPL-2.0-no-copyleft-exception', 'mplus', 'MS-LPL', 'MS-PL', 'MS-RL', 'MTLL', 'MulanPSL-1.0', 'MulanPSL-2.0', 'Multics', 'Mup', 'NAIST-2003', 'NASA-1.3', 'Naumen', 'NBPL-1.0', 'NCBI-PD', 'NCGL-UK-2.0', 'NCL', 'NCSA', 'Net-SNMP', 'NetCDF', 'Newsletr', 'NGPL', 'NICTA-1.0', 'NIST-PD', 'NIST-PD-fallback', 'NIST-Software', 'NLOD-1.0', 'NLOD-2.0', 'NLPL', 'Nokia', 'NOSL', 'Noweb', 'NPL-1.0', 'NPL-1.1', 'NPOSL-3.0', 'NRL', 'NTP', 'NTP-0', 'Nunit', 'O-UDA-1.0', 'OAR', 'OCCT-PL', 'OCLC-2.0', 'ODbL-1.0', 'ODC-By-1.0', 'OFFIS', 'OFL-1.0', 'OFL-1.0-no-RFN', 'OFL-1.0-RFN', 'OFL-1.1', 'OFL-1.1-no-RFN', 'OFL-1.1-RFN', 'OGC-1.0', 'OGDL-Taiwan-1.0', 'OGL-Canada-2.0', 'OGL-UK-1.0', 'OGL-UK-2.0', 'OGL-UK-3.0', 'OGTSL', 'OLDAP-1.1', 'OLDAP-1.2', 'OLDAP-1.3', 'OLDAP-1.4', 'OLDAP-2.0', 'OLDAP-2.0.1', 'OLDAP-2.1', 'OLDAP-2.2', 'OLDAP-2.2.1', 'OLDAP-2.2.2', 'OLDAP-2.3', 'OLDAP-2.4', 'OLDAP-2.5', 'OLDAP-2.6', 'OLDAP-2.7', 'OLDAP-2.8', 'OLFL-1.3', 'OML', 'OpenPBS-2.3', 'OpenSSL', 'OpenSSL-standalone', 'OpenVision', 'OPL-1.0', 'OPL-UK-3.0', 'OPUBL-1.0', 'OSET-PL-2.1', 'OSL-1.0', 'OSL-1.1', 'OSL-2.0', 'OSL-2.1', 'OSL-3.0', 'PADL', 'Parity-6.0.0', 'Parity-7.0.0', 'PDDL-1.0', 'PHP-3.0', 'PHP-3.01', 'Pixar', 'pkgconf', 'Plexus', 'pnmstitch', 'PolyForm-Noncommercial-1.0.0', 'PolyForm-Small-Business-1.0.0', 'PostgreSQL', 'PPL', 'PSF-2.0', 'psfrag', 'psutils', 'Python-2.0', 'Python-2.0.1', 'python-ldap', 'Qhull', 'QPL-1.0', 'QPL-1.0-INRIA-2004', 'radvd', 'Rdisc', 'RHeCos-1.1', 'RPL-1.1', 'RPL-1.5', 'RPSL-1.0', 'RSA-MD', 'RSCPL', 'Ruby', 'Ruby-pty', 'SAX-PD', 'SAX-PD-2.0', 'Saxpath', 'SCEA', 'SchemeReport', 'Sendmail', 'Sendmail-8.23', 'Sendmail-Open-Source-1.1', 'SGI-B-1.0', 'SGI-B-1.1', 'SGI-B-2.0', 'SGI-OpenGL', 'SGP4', 'SHL-0.5', 'SHL-0.51', 'SimPL-2.0', 'SISSL', 'SISSL-1.2', 'SL', 'Sleepycat', 'SMAIL-GPL', 'SMLNJ', 'SMPPL', 'SNIA', 'snprintf', 'softSurfer', 'Soundex', 'Spencer-86', 'Spencer-94', 'Spencer-99', 'SPL-1.0', 'ssh-keyscan', 'SSH-OpenSSH', 'SSH-short', 'SSLeay-standalone', 'SSPL-1.0', 'StandardML-NJ', 'SugarCRM-1.1.3', 'Sun-PPP', 'Sun-PPP-2000', 'SunPro', 'SWL', 'swrule', 'Symlinks', 'TAPR-OHL-1.0', 'TCL', 'TCP-wrappers', 'TermReadKey', 'TGPPL-1.0', 'ThirdEye', 'threeparttable', 'TMate', 'TORQUE-1.1', 'TOSL', 'TPDL', 'TPL-1.0', 'TrustedQSL', 'TTWL', 'TTYP0', 'TU-Berlin-1.0', 'TU-Berlin-2.0', 'Ubuntu-font-1.0', 'UCAR', 'UCL-1.0', 'ulem', 'UMich-Merit', 'Unicode-3.0', 'Unicode-DFS-2015', 'Unicode-DFS-2016', 'Unicode-TOU', 'UnixCrypt', 'Unlicense', 'UPL-1.0', 'URT-RLE', 'Vim', 'VOSTROM', 'VSL-1.0', 'W3C', 'W3C-19980720', 'W3C-20150513', 'w3m', 'Watcom-1.0', 'Widget-Workshop', 'Wsuipa', 'WTFPL', 'wwl', 'wxWindows', 'X11', 'X11-distribute-modifications-variant', 'X11-swapped', 'Xdebug-1.03', 'Xerox', 'Xfig', 'XFree86-1.1', 'xinetd', 'xkeyboard-config-Zinoviev', 'xlock', 'Xnet', 'xpp', 'XSkat', 'xzoom', 'YPL-1.0', 'YPL-1.1', 'Zed', 'Zeeff', 'Zend-2.0', 'Zimbra-1.3', 'Zimbra-1.4', 'Zlib', 'zlib-acknowledgement', 'ZPL-1.1', 'ZPL-2.0', 'ZPL-2.1']
 
 if os.sep == '\\':
     IGNORE_REGEXES = [item.replace('/', '\\\\') for item in IGNORE_REGEXES]
+IGNORE_PATTERNS = [re.compile(item) for item in IGNORE_REGEXES]
 
 observer = None
+history_local = threading.local()
+metrics = None
 full_install_done = False
-checksums = {}  # type: ignore[var-annotated]
+checksums = collections.OrderedDict()  # type: ignore[var-annotated]
+checksum_lock = threading.Lock()
+yaml_checks = collections.OrderedDict()  # type: ignore[var-annotated]
+yaml_check_lock = threading.Lock()
+hash_executor = None
+yaml_process_pool = None
 
-def checksum_is_same(path):
+def get_hash_executor():
+    global hash_executor
+    if hash_executor is None:
+        hash_executor = concurrent.futures.ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='dainstall-hash')
+    return hash_executor
+
+def get_yaml_process_pool():
+    global yaml_process_pool
+    if yaml_process_pool is None:
+        # The workers are spawned rather than forked because this process is running other threads.
+        yaml_process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=multiprocessing.get_context('spawn'))
+    return yaml_process_pool
+
+def file_digest(path):
+    digest = hashlib.blake2b()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def checksum_is_same(path, file_stat=None):
     path = os.path.abspath(path)
-    try:
-        with open(path, "rb") as fp:
-            new_checksum = hashlib.md5(fp.read()).hexdigest()
-        response = checksums.get(path, '') == new_checksum
-        checksums[path] = new_checksum
-    except FileNotFoundError:
-        response = True
+    if file_stat is None:
+        try:
+            file_stat = os.stat(path)
+        except FileNotFoundError:
+            return True
+        file_stat = (file_stat.st_size, file_stat.st_mtime_ns)
+    with checksum_lock:
+        previous = checksums.get(path, None)
+        if previous is not None:
+            checksums.move_to_end(path)
+    # A file whose size and mtime are unchanged is assumed to be unchanged, unless it was modified so close to when it was last hashed that a later write could share its mtime.
+    if previous is not None and previous['size'] == file_stat[0] and previous['mtime'] == file_stat[1] and file_stat[1] < previous['checked'] - CHECKSUM_RACY_WINDOW:
+        return True
+    entry = {'size': file_stat[0], 'mtime': file_stat[1], 'checked': time.time_ns(), 'digest': None}
+    if previous is not None and previous['size'] != file_stat[0]:
+        response = False
+    else:
+        try:
+            entry['digest'] = file_digest(path)
+        except FileNotFoundError:
+            return True
+        response = previous is not None and previous['digest'] == entry['digest']
+    remember_checksum(path, entry)
     return response
 
+def remember_checksum(path, entry):
+    with checksum_lock:
+        checksums[path] = entry
+        checksums.move_to_end(path)
+        while len(checksums) > CHECKSUM_CACHE_SIZE:
+            checksums.popitem(last=False)
+
+def write_and_remember(zf, path, arcname, compress_type, compresslevel):
+    """Writes a file into the archive and remembers the checksum of the bytes that were actually written."""
+    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+    zinfo.compress_type = compress_type
+    # This is what ZipFile.write() does; ZipFile.open() has no compresslevel argument.
+    zinfo._compresslevel = compresslevel if compresslevel is not None else zf.compresslevel
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as fp, zf.open(zinfo, 'w') as dest:
+        file_stat = os.fstat(fp.fileno())
+        checked = time.time_ns()
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            dest.write(chunk)
+    remember_checksum(os.path.abspath(path), {'size': file_stat.st_size, 'mtime': file_stat.st_mtime_ns, 'checked': checked, 'digest': digest.hexdigest()})
+
+def forget_checksum(path):
+    with checksum_lock:
+        checksums.pop(os.path.abspath(path), None)
+
+def forget_checksums():
+    with checksum_lock:
+        checksums.clear()
+
 def debug_log(args, message):
     if args.debug:
         sys.stderr.write(message + "\n")
@@ -51,18 +194,219 @@ def debug_log(args, message):
 class TerminalException(Exception):
     pass
 
+class InstallSuperseded(Exception):
+    """Raised when another dainstall process queued a newer install of the same package from the same directory."""
+    pass
+
 class GracefulExit(SystemExit):
     code = 1
 
-class WatchHandler(RegexMatchingEventHandler):
+class WatchMetrics:
+    """Counters and histograms describing the --watch pipeline, written as JSON lines or as a Prometheus text file."""
+
+    def __init__(self, path, output_format):
+        self.path = path
+        self.output_format = output_format
+        self.lock = threading.Lock()
+        self.counters = {name: 0 for name in METRICS_COUNTERS}
+        self.histograms = {}
+        for name, buckets in METRICS_HISTOGRAMS.items():
+            self.histograms[name] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+        if self.output_format == 'prometheus':
+            self.write_prometheus()
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def observe(self, name, value, **fields):
+        with self.lock:
+            histogram = self.histograms[name]
+            for index, bound in enumerate(histogram['buckets']):
+                if value <= bound:
+                    histogram['counts'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+            if self.output_format == 'jsonl':
+                self.write_line(dict(time=time.time(), metric=name, value=round(value, 6), **fields))
+
+    def flush(self):
+        with self.lock:
+            if self.output_format == 'jsonl':
+                self.write_line(dict(time=time.time(), metric='counters', **self.counters))
+            else:
+                self.write_prometheus()
+
+    def write_line(self, record):
+        if self.path is None:
+            return
+        try:
+            with open(self.path, 'a', encoding='utf-8') as fp:
+                fp.write(json.dumps(record) + "\n")
+        except OSError as err:
+            sys.stderr.write("Unable to write metrics to " + self.path + ": " + str(err) + "\n")
+
+    def write_prometheus(self):
+        if self.path is None:
+            return
+        lines = []
+        for name, value in self.counters.items():
+            lines.append("# TYPE dainstall_watch_" + name + "_total counter")
+            lines.append("dainstall_watch_" + name + "_total " + str(value))
+        for name, histogram in self.histograms.items():
+            lines.append("# TYPE dainstall_watch_" + name + " histogram")
+            for bound, count in zip(histogram['buckets'], histogram['counts']):
+                lines.append("dainstall_watch_" + name + '_bucket{le="' + repr(float(bound)) + '"} ' + str(count))
+            lines.append("dainstall_watch_" + name + '_bucket{le="+Inf"} ' + str(histogram['count']))
+            lines.append("dainstall_watch_" + name + "_sum " + repr(histogram['sum']))
+            lines.append("dainstall_watch_" + name + "_count " + str(histogram['count']))
+        try:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as fp:
+                fp.write("\n".join(lines) + "\n")
+            os.replace(temp_path, self.path)
+        except OSError as err:
+            sys.stderr.write("Unable to write metrics to " + self.path + ": " + str(err) + "\n")
+
+def observe_metric(name, value, **fields):
+    if metrics is not None:
+        metrics.observe(name, value, **fields)
+
+def increment_metric(name, amount=1):
+    if metrics is not None:
+        metrics.increment(name, amount)
+
+class EventIntake:
+    """Collects file system events in the watchdog thread and hands them to the event loop in batches.
+
+    Only the latest change to each path is kept, so a file that is
+    written many times while a batch is being collected is queued once,
+    and the event loop is woken once per batch rather than once per
+    event. If more than EVENT_PENDING_LIMIT paths change before the
+    batch is handed over, or if the queue has no room for the batch,
+    the individual changes are dropped and a single 'rescan' event is
+    queued instead, as soon as there is room for it, which causes the
+    whole package to be installed.
+    """
+
+    def __init__(self, queue, loop):
+        self.queue = queue
+        self.loop = loop
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.overflowed = False
+        self.flush_scheduled = False
+        self.rescan_queued = False
+
+    def add(self, event_type, is_directory, path):
+        now = time.time()
+        with self.lock:
+            if self.overflowed:
+                increment_metric('events_coalesced')
+            elif path in self.pending:
+                increment_metric('events_coalesced')
+                previous = self.pending[path]
+                # A file that was created and then modified is still new, and a file that was deleted and then recreated has to be uploaded again.
+                if event_type == 'modified' and previous[0] in ('created', 'deleted'):
+                    event_type = 'created' if previous[0] == 'created' else 'modified'
+                self.pending[path] = (event_type, is_directory, previous[2], now, previous[4] + 1)
+            elif len(self.pending) >= EVENT_PENDING_LIMIT:
+                increment_metric('events_coalesced', len(self.pending) + 1)
+                self.pending = {}
+                self.overflowed = True
+            else:
+                self.pending[path] = (event_type, is_directory, now, now, 1)
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        self.loop.call_soon_threadsafe(self.loop.call_later, EVENT_INTAKE_INTERVAL, self.flush)
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            overflowed = self.overflowed
+            self.pending = {}
+            self.overflowed = False
+            self.flush_scheduled = False
+        if not overflowed and self.queue.qsize() + len(pending) < self.queue.maxsize:
+            for path, (event_type, is_directory, first_time, last_time, count) in pending.items():
+                self.queue.put_nowait({'event_type': event_type, 'is_directory': is_directory, 'src_path': path, 'time': last_time, 'first_time': first_time, 'count': count})
+            return
+        if self.rescan_queued:
+            return
+        if self.queue.full():
+            # The changes are not dropped: the rescan is queued by a later flush, once the event loop has made room.
+            with self.lock:
+                self.overflowed = True
+                if self.flush_scheduled:
+                    return
+                self.flush_scheduled = True
+            self.loop.call_later(EVENT_INTAKE_INTERVAL, self.flush)
+            return
+        increment_metric('rescans')
+        self.rescan_queued = True
+        self.queue.put_nowait({'event_type': 'rescan', 'is_directory': True, 'src_path': '', 'time': time.time()})
+
+    def rescan_started(self):
+        self.rescan_queued = False
+
+    def is_idle(self):
+        with self.lock:
+            return len(self.pending) == 0 and not self.overflowed and not self.flush_scheduled
+
+
+class TraceRecorder:
+    """Writes the file system events that --watch mode acts on to a file, one JSON object per line, for --replay-trace."""
+
+    def __init__(self, path, directory):
+        self.directory = os.path.abspath(directory)
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.count = 0
+        self.fp = open(path, 'w', encoding='utf-8', buffering=1)
+        self.fp.write(json.dumps({'trace': TRACE_VERSION, 'directory': self.directory, 'started': self.start}) + "\n")
+
+    def record(self, event_type, is_directory, path, file_stat):
+        line = json.dumps({'t': round(time.time() - self.start, 4), 'event': event_type, 'dir': is_directory, 'path': '/'.join(os.path.relpath(path, self.directory).split(os.sep)), 'size': file_stat[0] if file_stat is not None else None, 'mtime': file_stat[1] if file_stat is not None else None})
+        with self.lock:
+            if self.fp is not None:
+                self.fp.write(line + "\n")
+                self.count += 1
+
+    def close(self):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+
+
+class WatchHandler(FileSystemEventHandler):
     def __init__(self, queue: asyncio.Queue, loop: asyncio.BaseEventLoop, data: dict, *args, **kwargs):
         self._loop = loop
         self._queue = queue
         self._data = data
+        self._intake = data['intake']
         super().__init__(*args, **kwargs)
 
+    def dispatch(self, event):
+        # Treat a move as a deletion of the old path and a creation of the new path, so that each side is filtered on its own and renames can be applied incrementally.
+        if event.event_type == 'moved':
+            if event.is_directory:
+                self.dispatch(DirDeletedEvent(event.src_path))
+                self.dispatch(DirCreatedEvent(event.dest_path))
+            else:
+                self.dispatch(FileDeletedEvent(event.src_path))
+                self.dispatch(FileCreatedEvent(event.dest_path))
+            return
+        # The file index uses the same test, so that a file whose events are dropped here is never indexed.
+        if path_is_watch_ignored(event.src_path):
+            return
+        super().dispatch(event)
+
     def on_any_event(self, event):
-        if event.event_type not in ('opened', 'closed') and not (event.is_directory and event.event_type == 'modified'):
+        if event.event_type in ('opened', 'closed', 'closed_no_write') or (event.is_directory and event.event_type == 'modified'):
+            increment_metric('events_ignored')
+        else:
             debug_log(self._data['args'], "Got event " + repr(event.event_type) + " on " + repr(event.src_path))
             invalid = False
             the_path = os.path.abspath(event.src_path)
@@ -70,8 +414,16 @@ class WatchHandler(RegexMatchingEventHandler):
                 if the_path.startswith(comparison_path):
                     invalid = True
                     break
-            if not invalid:
-                self._loop.call_soon_threadsafe(self._queue.put_nowait, {'event_type': event.event_type, 'is_directory': event.is_directory, 'src_path': the_path, 'time': time.time()})
+            if not invalid and len(self._data['install_ignore']) > 0 and path_is_ignored('/'.join(the_path[self._data['trim']:].split(os.sep)), self._data['install_ignore'], is_directory=event.is_directory):
+                invalid = True
+            if invalid:
+                increment_metric('events_ignored')
+            else:
+                increment_metric('events_received')
+                self._data['file_index'].update(the_path, event.event_type, event.is_directory)
+                if self._data.get('trace') is not None:
+                    self._data['trace'].record(event.event_type, event.is_directory, the_path, self._data['file_index'].stat(the_path))
+                self._intake.add(event.event_type, event.is_directory, the_path)
 
 def update_to_do(queue, to_do):
     try:
@@ -80,147 +432,147 @@ def update_to_do(queue, to_do):
     except asyncio.QueueEmpty:
         pass
 
+async def wait_until_settled(queue, to_do, data):
+    """Waits until events stop arriving and git is not changing the working tree.
+
+    Returns True if the events look like a bulk operation, such as a git
+    checkout, rebase, or stash pop, rather than editing, in which case
+    the whole package should be installed once the operation is over.
+    """
+    bulk = False
+    wait_start = time.time()
+    announced = None
+    while True:
+        update_to_do(queue, to_do)
+        now = time.time()
+        if not bulk and sum(event.get('count', 1) for event in to_do if now - event['time'] < EVENT_STORM_WINDOW) >= EVENT_STORM_COUNT:
+            debug_log(data['args'], "Events are arriving too quickly to be from editing; waiting for them to stop")
+            bulk = True
+        operation = data['git'].operation()
+        if operation is not None:
+            bulk = True
+            if now - wait_start < GIT_PAUSE_LIMIT:
+                if announced != operation:
+                    sys.stdout.write("Waiting for " + operation + " to finish before installing changes.\n")
+                    sys.stdout.flush()
+                    announced = operation
+                await asyncio.sleep(0.1)
+                continue
+            sys.stderr.write("Installing changes even though " + operation + " has not finished after " + str(GIT_PAUSE_LIMIT) + " seconds.\n")
+            break
+        # If it looks like the events are still coming in, wait and check the queue again.  Only a bulk operation waits for git to stop moving HEAD.
+        if now - max(event['time'] for event in to_do) >= (EVENT_STORM_QUIET if bulk else 0.05) and (not bulk or data['git'].seconds_since_change() >= GIT_QUIET):
+            break
+        await asyncio.sleep(0.1)
+    update_to_do(queue, to_do)
+    return bulk
+
+
 async def handle_event_after_delay(queue, to_do, data):
-    global full_install_done
+    loop = asyncio.get_running_loop()
     await asyncio.sleep(SETTLE_DELAY)
-    first_time = True
-    something_done = False
     while len(to_do) > 0:
         manual_mode = False
         for event in to_do:
             if event['event_type'] == 'manual':
                 manual_mode = True
-                first_time = False
                 break
-        if first_time:
-            update_to_do(queue, to_do)
-            while time.time() - to_do[-1]['time'] < 0.05:  # If it looks like the events are still coming in, wait and check the queue again
-                await asyncio.sleep(0.1)
-                update_to_do(queue, to_do)
-            try:
-                to_do.append(queue.get_nowait())
-            except asyncio.QueueEmpty:
-                pass
-        events_by_type = {}
-        for event in to_do:
-            if event['src_path'] in events_by_type:
-                if event['event_type'] == 'deleted':
-                    del events_by_type[event['src_path']]
-                else:
-                    if 'deleted' in events_by_type[event['src_path']]:
-                        del events_by_type[event['src_path']]['deleted']
-                        if len(events_by_type[event['src_path']]) == 0:
-                            del events_by_type[event['src_path']]
-            if event['event_type'] == 'modified' and checksum_is_same(event['src_path']):
-                debug_log(data['args'], event['src_path'] + " was not actually changed, or has already been deleted; disregarding.")
-                continue
-            if event['src_path'] not in events_by_type:
-                events_by_type[event['src_path']] = {}
-            events_by_type[event['src_path']][event['event_type']] = event
+        bulk = False
+        if not manual_mode:
+            bulk = await wait_until_settled(queue, to_do, data)
+        rescan = any(event['event_type'] == 'rescan' for event in to_do)
+        if rescan:
+            data['intake'].rescan_started()
+        batch_start = min(event.get('first_time', event['time']) for event in to_do)
+        observe_metric('debounce_seconds', time.time() - max(event['time'] for event in to_do))
+        observe_metric('batch_events', len(to_do))
         unduplicated_to_do = []
-        for file_path, events in events_by_type.items():
-            if 'manual' in events:
-                unduplicated_to_do.append(events['manual'])
-            elif 'created' in events:
-                unduplicated_to_do.append(events['created'])
-            elif 'modified' in events:
-                unduplicated_to_do.append(events['modified'])
-            elif 'deleted' in events:
-                unduplicated_to_do.append(events['deleted'])
+        if rescan:
+            sys.stdout.write("Too many files changed at once to track them individually; rescanning and installing the whole package.\n")
+            sys.stdout.flush()
+            forget_checksums()
+            await loop.run_in_executor(None, data['file_index'].rescan)
+            data['scheduler'].request(watch_batch_restart(data['args'], [], data['norestart'], True), batch_start, 'full')
+        else:
+            modified_paths = list(set(event['src_path'] for event in to_do if event['event_type'] == 'modified'))
+            hash_start = time.time()
+            is_same = data['replay'].checksum_is_same if data.get('replay') is not None else checksum_is_same
+            unchanged = dict(zip(modified_paths, await asyncio.gather(*[loop.run_in_executor(get_hash_executor(), is_same, path, data['file_index'].stat(path)) for path in modified_paths])))
+            if len(modified_paths) > 0:
+                observe_metric('hash_seconds', time.time() - hash_start, files=len(modified_paths))
+            events_by_type = {}
+            for event in to_do:
+                if event['src_path'] in events_by_type:
+                    if event['event_type'] == 'deleted':
+                        del events_by_type[event['src_path']]
+                    else:
+                        if 'deleted' in events_by_type[event['src_path']]:
+                            del events_by_type[event['src_path']]['deleted']
+                            if len(events_by_type[event['src_path']]) == 0:
+                                del events_by_type[event['src_path']]
+                if event['event_type'] == 'modified' and unchanged[event['src_path']]:
+                    increment_metric('events_unchanged')
+                    debug_log(data['args'], event['src_path'] + " was not actually changed, or has already been deleted; disregarding.")
+                    continue
+                if event['src_path'] not in events_by_type:
+                    events_by_type[event['src_path']] = {}
+                events_by_type[event['src_path']][event['event_type']] = event
+            for file_path, events in events_by_type.items():
+                if 'manual' in events:
+                    unduplicated_to_do.append(events['manual'])
+                elif 'created' in events:
+                    unduplicated_to_do.append(events['created'])
+                elif 'modified' in events:
+                    unduplicated_to_do.append(events['modified'])
+                elif 'deleted' in events:
+                    unduplicated_to_do.append(events['deleted'])
+        increment_metric('batches')
+        if bulk:
+            increment_metric('bulk_batches')
+        observe_metric('batch_changes', len(unduplicated_to_do))
         if len(unduplicated_to_do) > 0:
-            something_done = True
-            if not data['args'].norestart and full_install_done and not data['args'].force_restart and not manual_mode:
-                # The installation will not trigger a restart unless:
-                # 1. A flag specifies that a restart should or should not happen.
-                # 2. This is the first install.
-                # 3. The installer is triggered manually.
-                data['args'].norestart = True
-                debug_log(data['args'], "norestart is True initially")
-                for event in unduplicated_to_do:
-                    debug_log(data['args'], "considering event " + repr(event))
-                    if event['event_type'] == 'manual' or event['src_path'].endswith('.py'):
-                        debug_log(data['args'], "norestart is now False")
-                        data['args'].norestart = False
-                        break
-            debug_log(data['args'], "not going to restart the server" if data['args'].norestart else "going to restart the server")
+            restart = watch_batch_restart(data['args'], unduplicated_to_do, data['norestart'], not full_install_done or manual_mode)
+            debug_log(data['args'], "going to restart the server" if restart else "not going to restart the server")
             if manual_mode:
                 single_file_appropriate = False
             else:
-                if not full_install_done:
+                if not full_install_done or bulk:
                     single_file_appropriate = False
                 else:
                     single_file_appropriate = data['args'].playground
-                    if single_file_appropriate:
-                        for event in unduplicated_to_do:
-                            if event['src_path'].endswith('.py') and event['event_type'] == 'deleted':
-                                single_file_appropriate = False
-                                break
-                sys.stdout.write("Detected changes to:\n")
-                for path in set(item['src_path'][data['trim']:] for item in unduplicated_to_do):
-                    sys.stdout.write(f"{path}\n")
+                if bulk:
+                    sys.stdout.write(f"Detected changes to {len(unduplicated_to_do)} files from a bulk operation, such as a git checkout or rebase; installing the whole package.\n")
+                else:
+                    sys.stdout.write("Detected changes to:\n")
+                    for path in set(item['src_path'][data['trim']:] for item in unduplicated_to_do):
+                        sys.stdout.write(f"{path}\n")
                 sys.stdout.flush()
             if single_file_appropriate:
-                other_files_involved = False
-                todo_by_folder = {'questions': set(), 'sources': set(), 'static': set(), 'templates': set(), 'modules': set()}
                 for event in unduplicated_to_do:
-                    if event['is_directory']:
-                        debug_log(data['args'], event['src_path'] + " is a directory, so skipping it")
-                        continue
                     if event['event_type'] == 'deleted':
-                        debug_log(data['args'], event['src_path'] + " was deleted, so no need to upload anything")
-                        if event['src_path'] in checksums:
-                            del checksums[event['src_path']]
-                        continue
-                    path = '/'.join(os.path.normpath(event['src_path']).split(os.sep))
-                    m = re.search(r'/docassemble/([^/]+)/data/([^/]+)/', path)
-                    if m:
-                        if m.group(2) in ('questions', 'sources', 'static', 'templates'):
-                            todo_by_folder[m.group(2)].add(event['src_path'])
-                    else:
-                        m = re.search(r'/docassemble/([^/]+)/([^/]+)\.py$', path)
-                        if m:
-                            todo_by_folder['modules'].add(event['src_path'])
-                        else:
-                            other_files_involved = True
-                            debug_log(data['args'], event['src_path'] + " changed, so the whole package will be uploaded")
-                            break
-                if other_files_involved:
-                    try:
-                        do_install(data['args'], data['apikey'], data['apiurl'], data['to_ignore'])
-                    except TerminalException as err:
-                        sys.stderr.write("Install failed: " + str(err) + "\n")
+                        forget_checksum(event['src_path'])
+                todo_by_folder = classify_playground_changes(data['args'], unduplicated_to_do)
+                if todo_by_folder is None:
+                    data['scheduler'].request(restart, batch_start, 'full')
                 else:
-                    for folder in ('questions', 'sources', 'static', 'templates', 'modules'):
-                        if len(todo_by_folder[folder]) > 0:
-                            debug_log(data['args'], "Uploading " + repr(todo_by_folder[folder]) + " to " + folder)
-                            list_of_files = list(todo_by_folder[folder])
-                            for file_path in list_of_files:
-                                sys.stdout.write("Uploading " + file_path[data['trim']:] + " to " + folder + "\n")
-                                sys.stdout.flush()
-                                post_data = {'folder': folder, 'restart': '1' if folder == 'modules' and file_path == list_of_files[-1] else '0'}
-                                if data['args'].project and data['args'].project != 'default':
-                                    post_data['project'] = data['args'].project
-                                try:
-                                    r = requests.post(data['apiurl'] + '/api/playground', data=post_data, files={'file': open(file_path, 'rb')}, headers={'X-API-Key': data['apikey']}, timeout=50)
-                                    if r.status_code == 200:
-                                        try:
-                                            info = r.json()
-                                        except:
-                                            raise TerminalException("Server did not return JSON: " + r.text)
-                                        task_id = info['task_id']
-                                        success = wait_for_server(True, task_id, data['apikey'], data['apiurl'])
-                                        if not success:
-                                            sys.stderr.write("Failed to upload " + file_path + ". Restart process did not return a success code.\n")
-                                    elif r.status_code == 204:
-                                        success = True
-                                    else:
-                                        success = False
-                                    if not success:
-                                        sys.stderr.write("Failed to upload " + file_path + "\n" + r.text + "\n")
-                                except requests.exceptions.Timeout:
-                                    sys.stderr.write("Server timed out while uploading " + file_path)
-                                except FileNotFoundError:
-                                    sys.stderr.write(file_path + " disappeared during processing\n")
+                    if data['args'].validate:
+                        interview_paths = [file_path for file_path, action in todo_by_folder['questions'].items() if action == 'upload' and is_interview_file(file_path)]
+                        if len(interview_paths) > 0:
+                            invalid = await loop.run_in_executor(None, check_interview_files, interview_paths)
+                            if report_invalid_interview_files(data['args'], invalid, data['args'].directory):
+                                for file_path in invalid:
+                                    sys.stderr.write("Not uploading " + file_path[data['trim']:] + " until its YAML is fixed.\n")
+                                    del todo_by_folder['questions'][file_path]
+                    jobs, background_jobs = order_playground_uploads(todo_by_folder, data['file_index'])
+                    for job in jobs + background_jobs:
+                        debug_log(data['args'], "Going to " + job['action'] + " " + job['file_path'] + " in " + job['folder'] + (" in the background" if job['background'] else ''))
+                        job['generation'] = claim_upload(data, job['file_path'])
+                    tasks = [asyncio.create_task(upload_playground_batch(data, jobs, batch_start, len(background_jobs)))]
+                    for job in background_jobs:
+                        tasks.append(asyncio.create_task(upload_in_background(data, job, batch_start)))
+                    for task in tasks:
+                        data['upload_tasks'].add(task)
+                        task.add_done_callback(data['upload_tasks'].discard)
             else:
                 if manual_mode:
                     important_file_updated = True
@@ -233,16 +585,13 @@ async def handle_event_after_delay(queue, to_do, data):
                             important_file_updated = True
                             break
                 if important_file_updated:
-                    try:
-                        if not full_install_done:
-                            if manual_mode:
-                                sys.stdout.write("Doing an initial upload of the whole package to make sure the current version of the package exists in the Playground. Subsequent uploads will be incremental.\n")
-                            sys.stdout.flush()
-                        do_install(data['args'], data['apikey'], data['apiurl'], data['to_ignore'])
-                        full_install_done = True
-                        debug_log(data['args'], "Finished the full install.")
-                    except TerminalException as err:
-                        sys.stderr.write("Install failed: " + str(err) + "\n")
+                    if not full_install_done:
+                        if manual_mode:
+                            sys.stdout.write("Doing an initial upload of the whole package to make sure the current version of the package exists in the Playground. Subsequent uploads will be incremental.\n")
+                        sys.stdout.flush()
+                    data['scheduler'].request(restart, batch_start, 'manual' if manual_mode else 'full')
+        if metrics is not None:
+            metrics.flush()
         debug_log(data['args'], "Starting marking events as handled")
         for event in to_do:  # pylint: disable=unused-variable
             queue.task_done()
@@ -251,25 +600,532 @@ async def handle_event_after_delay(queue, to_do, data):
         debug_log(data['args'], "Starting seeing if any additional events arrived")
         update_to_do(queue, to_do)
         debug_log(data['args'], "Finished seeing if any additional events arrived")
-        first_time = False
-    if something_done:
+
+def watch_batch_restart(args, changes, norestart, always):
+    # The installation will not trigger a restart unless:
+    # 1. A flag specifies that a restart should or should not happen.
+    # 2. This is the first install.
+    # 3. The installer is triggered manually.
+    # 4. A .py file changed.
+    if norestart:
+        return False
+    if always or args.force_restart:
+        return True
+    for event in changes:
+        debug_log(args, "considering event " + repr(event))
+        if event['event_type'] == 'manual' or event['src_path'].endswith('.py'):
+            return True
+    return False
+
+
+def classify_playground_changes(args, changes):
+    """Sorts the changes in a --watch batch by the Playground folder they belong in.
+
+    Returns {folder: {file_path: 'upload' or 'delete'}}, or None if a
+    file that is not kept in a Playground folder changed, in which case
+    the whole package has to be installed.
+    """
+    todo_by_folder = {'questions': {}, 'sources': {}, 'static': {}, 'templates': {}, 'modules': {}}
+    for event in changes:
+        if event['is_directory']:
+            debug_log(args, event['src_path'] + " is a directory, so skipping it")
+            continue
+        action = 'delete' if event['event_type'] == 'deleted' else 'upload'
+        folder = playground_folder_of(event['src_path'])
+        if folder is not None:
+            todo_by_folder[folder][event['src_path']] = action
+        elif action == 'delete':
+            debug_log(args, event['src_path'] + " was deleted, but it is not stored in the Playground, so there is nothing to delete")
+        else:
+            debug_log(args, event['src_path'] + " changed, so the whole package will be uploaded")
+            return None
+    return todo_by_folder
+
+
+def order_playground_uploads(todo_by_folder, file_index):
+    """Decides the order in which a batch of Playground changes is sent to the server.
+
+    Returns a list of jobs to send one at a time and a list of jobs to
+    send in the background. Folders are sent in UPLOAD_LANE_ORDER, and
+    within a folder deletions go first and smaller files before larger
+    ones, so that the changes that can be seen soonest reach the server
+    first. Files in data folders of at least UPLOAD_BACKGROUND_SIZE bytes
+    are sent in the background. Only the last module restarts the server.
+    """
+    jobs = []
+    background_jobs = []
+    for folder in UPLOAD_LANE_ORDER:
+        sizes = {}
+        for file_path, action in todo_by_folder[folder].items():
+            file_stat = file_index.stat(file_path) if action == 'upload' else None
+            sizes[file_path] = file_stat[0] if file_stat is not None else 0
+        # Deletions go first so that a renamed module only causes one restart, after its new name has been uploaded.
+        for file_path in sorted(todo_by_folder[folder], key=lambda file_path: (todo_by_folder[folder][file_path] != 'delete', sizes[file_path], file_path)):
+            job = {'file_path': file_path, 'folder': folder, 'action': todo_by_folder[folder][file_path], 'size': sizes[file_path], 'restart': False, 'background': folder != 'modules' and sizes[file_path] >= UPLOAD_BACKGROUND_SIZE}
+            if job['background']:
+                background_jobs.append(job)
+            else:
+                jobs.append(job)
+    if len(jobs) > 0 and jobs[-1]['folder'] == 'modules':
+        jobs[-1]['restart'] = True
+    return jobs, background_jobs
+
+
+async def run_full_install(data, batch_start, mode):
+    loop = asyncio.get_running_loop()
+    install_start = time.time()
+    try:
+        install = data['replay'].install if data.get('replay') is not None else do_install
+        restarted = await loop.run_in_executor(None, install, data['args'], data['apikey'], data['apiurl'], data['to_ignore'], data['file_index'])
+    except (TerminalException, OSError) as err:
+        sys.stderr.write("Install failed: " + str(err) + "\n")
+        return None
+    increment_metric('installs')
+    observe_metric('install_seconds', time.time() - install_start, mode=mode)
+    observe_metric('save_to_live_seconds', time.time() - batch_start, mode=mode)
+    return restarted
+
+
+class InstallScheduler:
+    """Runs the full installs of --watch mode one at a time.
+
+    Changes that arrive while an install is running are merged into a
+    single pending install, and an install that would restart the
+    server waits until at least --restart-interval seconds have passed
+    since the previous restart.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.task = None
+        self.running = False
+        self.pending = None
+        self.last_restart = None
+
+    def restart_wait(self):
+        if self.last_restart is None:
+            return 0.0
+        return max(0.0, self.data['args'].restart_interval - (time.time() - self.last_restart))
+
+    def state(self):
+        return {'running': self.running, 'pending': self.pending is not None, 'pending_restart': self.pending is not None and self.pending['restart'], 'restart_wait': round(self.restart_wait(), 1)}
+
+    def is_idle(self):
+        return self.task is None or self.task.done()
+
+    def request(self, restart, batch_start, mode):
+        if self.pending is None:
+            self.pending = {'restart': restart, 'batch_start': batch_start, 'mode': mode}
+        else:
+            self.pending['restart'] = self.pending['restart'] or restart
+            self.pending['batch_start'] = min(self.pending['batch_start'], batch_start)
+            sys.stdout.write("These changes will be included in the install that is already queued.\n")
+            sys.stdout.flush()
+        if self.running:
+            sys.stdout.write("An install is in progress; another install will start when it finishes.\n")
+            sys.stdout.flush()
+        debug_log(self.data['args'], "Install queue: " + repr(self.state()))
+        if self.is_idle():
+            self.task = asyncio.create_task(self.run())
+
+    async def wait_until_idle(self):
+        while not self.is_idle():
+            await asyncio.wait([self.task])
+
+    async def run(self):
+        global full_install_done
+        while self.pending is not None:
+            wait = self.restart_wait() if self.pending['restart'] else 0.0
+            if wait > 0:
+                sys.stdout.write(f"Waiting {wait:.0f} seconds before installing so that the server restarts at most once every {self.data['args'].restart_interval:g} seconds.\n")
+                sys.stdout.flush()
+                # Changes that arrive during the wait are merged into the pending install.
+                await asyncio.sleep(wait)
+                continue
+            job = self.pending
+            self.pending = None
+            self.running = True
+            try:
+                await supersede_uploads(self.data)
+                self.data['args'].norestart = not job['restart']
+                restarted = await run_full_install(self.data, job['batch_start'], job['mode'])
+            except InstallSuperseded:
+                # Nothing was installed, so the job stays pending until the other process has finished.
+                sys.stdout.write("Superseded by a newer install of this directory; installing again once it has finished.\n")
+                sys.stdout.flush()
+                if self.pending is None:
+                    self.pending = job
+                else:
+                    self.pending['restart'] = self.pending['restart'] or job['restart']
+                    self.pending['batch_start'] = min(self.pending['batch_start'], job['batch_start'])
+                continue
+            finally:
+                self.running = False
+            if restarted is not None:
+                full_install_done = True
+                debug_log(self.data['args'], "Finished the full install.")
+                if restarted:
+                    self.last_restart = time.time()
+            sys.stdout.write("Done.\n")
+            sys.stdout.flush()
+            if metrics is not None:
+                metrics.flush()
+
+
+def claim_upload(data, file_path):
+    if file_path not in data['uploads']:
+        data['uploads'][file_path] = {'generation': 0, 'post': None}
+    data['uploads'][file_path]['generation'] += 1
+    return data['uploads'][file_path]['generation']
+
+
+async def supersede_uploads(data):
+    pending = []
+    for file_path, upload in data['uploads'].items():
+        upload['generation'] += 1
+        if upload['post'] is not None and not upload['post'].done():
+            debug_log(data['args'], "Waiting for the upload of " + file_path + " to finish before uploading the whole package")
+            pending.append(upload['post'])
+    if len(pending) > 0:
+        await asyncio.wait(pending)
+
+
+def playground_folder_of(file_path):
+    path = '/'.join(os.path.normpath(file_path).split(os.sep))
+    m = re.search(r'/docassemble/([^/]+)/data/([^/]+)/', path)
+    if m:
+        if m.group(2) in ('questions', 'sources', 'static', 'templates'):
+            return m.group(2)
+        return None
+    m = re.search(r'/docassemble/([^/]+)/([^/]+)\.py$', path)
+    if m:
+        return 'modules'
+    return None
+
+
+def delete_playground_file(data, file_path, folder, restart):
+    params = {'folder': folder, 'filename': os.path.basename(file_path), 'restart': '1' if restart else '0'}
+    if data['args'].project and data['args'].project != 'default':
+        params['project'] = data['args'].project
+    return requests.delete(data['apiurl'] + '/api/playground', params=params, headers={'X-API-Key': data['apikey']}, timeout=UPLOAD_TIMEOUT)
+
+
+def post_playground_file(data, file_path, folder, restart):
+    post_data = {'folder': folder, 'restart': '1' if restart else '0'}
+    if data['args'].project and data['args'].project != 'default':
+        post_data['project'] = data['args'].project
+    with open(file_path, 'rb') as fp:
+        return post_with_retries(data['apiurl'] + '/api/playground', post_data, 'file', fp, os.path.basename(file_path), data['apikey'], "Upload of " + file_path[data['trim']:], not restart)
+
+
+async def sync_playground_file(data, job):
+    """Uploads or deletes one file in the Playground; returns True if the server has the change."""
+    loop = asyncio.get_running_loop()
+    file_path = job['file_path']
+    folder = job['folder']
+    verb = 'delete' if job['action'] == 'delete' else 'upload'
+    upload = data['uploads'][file_path]
+    if upload['post'] is not None and not upload['post'].done():
+        debug_log(data['args'], "Waiting for an earlier change to " + file_path + " to reach the server")
+        await asyncio.wait([upload['post']])
+    if upload['generation'] != job['generation']:
+        debug_log(data['args'], "Not going to " + verb + " " + file_path + " because a newer change to it is pending")
+        return False
+    if verb == 'delete':
+        sys.stdout.write("Deleting " + file_path[data['trim']:] + " from " + folder + "\n")
+    else:
+        sys.stdout.write("Uploading " + file_path[data['trim']:] + " to " + folder + "\n")
+    sys.stdout.flush()
+    upload_start = time.time()
+    replay = data.get('replay')
+    if verb == 'delete':
+        send = replay.delete_playground_file if replay is not None else delete_playground_file
+    else:
+        send = replay.post_playground_file if replay is not None else post_playground_file
+    upload['post'] = post = loop.run_in_executor(None, send, data, file_path, folder, job['restart'])
+    await asyncio.wait([post])
+    if verb == 'upload':
+        increment_metric('uploads')
+        observe_metric('upload_seconds', time.time() - upload_start, folder=folder)
+    try:
+        r = post.result()
+    except TerminalException as err:
+        sys.stderr.write(str(err) + "\n")
+        return False
+    except requests.exceptions.RequestException as err:
+        sys.stderr.write("Failed to " + verb + " " + file_path + ": " + str(err) + "\n")
+        return False
+    except FileNotFoundError:
+        sys.stderr.write(file_path + " disappeared during processing\n")
+        return False
+    if upload['generation'] != job['generation']:
+        debug_log(data['args'], "Discarding the result of a stale " + verb + " of " + file_path)
+        return False
+    if r.status_code == 200:
+        try:
+            info = r.json()
+            task_id = info['task_id']
+        except:
+            sys.stderr.write("Failed to " + verb + " " + file_path + ". Server did not return JSON: " + r.text + "\n")
+            return False
+        try:
+            success = await loop.run_in_executor(None, replay.wait_for_server if replay is not None else wait_for_server, True, task_id, data['apikey'], data['apiurl'])
+        except TerminalException as err:
+            sys.stderr.write(str(err) + "\n")
+            success = False
+        if not success:
+            sys.stderr.write("Failed to " + verb + " " + file_path + ". Restart process did not return a success code.\n")
+        return success
+    if r.status_code == 404 and verb == 'delete':
+        debug_log(data['args'], file_path + " was not in the Playground")
+    elif r.status_code != 204:
+        sys.stderr.write("Failed to " + verb + " " + file_path + "\n" + r.text + "\n")
+        return False
+    return True
+
+
+async def upload_playground_batch(data, jobs, batch_start, background_count=0):
+    # A full install that is running or queued was built from older files, so let it finish before sending newer ones.
+    await data['scheduler'].wait_until_idle()
+    for job in jobs:
+        await sync_playground_file(data, job)
+    if len(jobs) > 0:
+        observe_metric('save_to_live_seconds', time.time() - batch_start, mode='single', files=len(jobs))
+        if metrics is not None:
+            metrics.flush()
+    if background_count > 0:
+        sys.stdout.write(f"Done, except for {background_count} large " + ('file' if background_count == 1 else 'files') + " uploading in the background.\n")
+    else:
         sys.stdout.write("Done.\n")
+    sys.stdout.flush()
+
+
+async def upload_in_background(data, job, batch_start):
+    await data['scheduler'].wait_until_idle()
+    async with data['background_slots']:
+        upload_start = time.time()
+        succeeded = await sync_playground_file(data, job)
+    if succeeded:
+        observe_metric('save_to_live_seconds', time.time() - batch_start, mode='background', files=1)
+        if metrics is not None:
+            metrics.flush()
+        sys.stdout.write(f"Finished uploading {job['file_path'][data['trim']:]} in the background after {time.time() - upload_start:.1f} seconds.\n")
         sys.stdout.flush()
 
+
+class ReplayResponse:
+    def __init__(self, restart):
+        self.status_code = 200 if restart else 204
+        self.text = ''
+
+    def json(self):
+        return {'task_id': 'replay'}
+
+
+class ReplayMetrics(WatchMetrics):
+    """WatchMetrics that also keeps each save-to-live time, for the --replay-trace report."""
+
+    def __init__(self, path, output_format):
+        self.save_to_live = collections.defaultdict(list)
+        super().__init__(path, output_format)
+
+    def observe(self, name, value, **fields):
+        if name == 'save_to_live_seconds':
+            with self.lock:
+                self.save_to_live[fields.get('mode', 'full')].append(value)
+        super().observe(name, value, **fields)
+
+
+class TraceReplay:
+    """Feeds a trace written by --record-trace through the --watch pipeline, with a simulated server.
+
+    The events are replayed with their original timing, except that
+    pauses longer than REPLAY_IDLE_GAP are shortened while nothing is
+    pending. Whether a modified file really changed is decided from the
+    size and modification time in the trace instead of from its
+    contents. The server methods have the signatures of the functions
+    they stand in for and sleep for the simulated time of the request.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, 'r', encoding='utf-8') as fp:
+                lines = fp.read().splitlines()
+        except OSError as err:
+            raise TerminalException("Unable to read " + path + ": " + str(err))
+        try:
+            header = json.loads(lines[0]) if len(lines) > 0 else {}
+            if not isinstance(header, dict) or header.get('trace') != TRACE_VERSION:
+                raise TerminalException(path + " is not a trace written by --record-trace.")
+            self.events = sorted((json.loads(line) for line in lines[1:] if line.strip() != ''), key=lambda event: event['t'])
+        except (ValueError, KeyError, TypeError) as err:
+            raise TerminalException("Unable to read the trace in " + path + ": " + str(err))
+        self.lock = threading.Lock()
+        self.hashed = {}
+        self.counts = {'installs': 0, 'restarting_installs': 0, 'uploads': 0, 'upload_bytes': 0, 'deletions': 0, 'restarts': 0}
+        self.server_seconds = 0.0
+        self.replay_seconds = 0.0
+        self.skipped_seconds = 0.0
+
+    def is_idle(self, data, queue):
+        return data['intake'].is_idle() and queue.empty() and (data.get('batch_task') is None or data['batch_task'].done()) and data['scheduler'].is_idle() and len(data['upload_tasks']) == 0
+
+    def apply(self, data, event):
+        path = os.path.join(os.path.abspath(data['args'].directory), *event['path'].split('/'))
+        if event['dir']:
+            if event['event'] == 'deleted':
+                data['file_index'].update(path, 'deleted', True)
+        else:
+            data['file_index'].set_stat(path, (event['size'], event['mtime']) if event['event'] != 'deleted' and event['size'] is not None else None)
+        increment_metric('events_received')
+        data['intake'].add(event['event'], event['dir'], path)
+
+    async def run(self, data, queue):
+        start = time.time()
+        if data['args'].playground:
+            await queue.put({'event_type': 'manual', 'is_directory': False, 'src_path': '', 'time': start})
+        for event in self.events:
+            while True:
+                wait = start + event['t'] - self.skipped_seconds - time.time()
+                if wait <= 0:
+                    break
+                if wait > REPLAY_IDLE_GAP and self.is_idle(data, queue):
+                    self.skipped_seconds += wait - REPLAY_IDLE_GAP
+                    continue
+                await asyncio.sleep(min(wait, 0.1))
+            self.apply(data, event)
+        while not self.is_idle(data, queue):
+            await asyncio.sleep(0.1)
+        self.replay_seconds = time.time() - start
+
+    def simulate(self, seconds, **counts):
+        time.sleep(seconds)
+        with self.lock:
+            self.server_seconds += seconds
+            for name, amount in counts.items():
+                self.counts[name] += amount
+
+    def checksum_is_same(self, path, file_stat=None):
+        if file_stat is None:
+            return True
+        with self.lock:
+            previous = self.hashed.get(path, None)
+            self.hashed[path] = file_stat
+        return previous == file_stat
+
+    def install(self, args, apikey, apiurl, to_ignore, file_index=None):
+        restart = not args.norestart
+        file_stats = {path: file_index.stat(os.path.join(file_index.directory, *path.split('/'))) for path in file_index.paths()}
+        # Like build_archive(), remember the files as they were when the archive was built.
+        with self.lock:
+            for path, file_stat in file_stats.items():
+                self.hashed[os.path.join(file_index.directory, *path.split('/'))] = file_stat
+        upload_bytes = sum(file_stat[0] for file_stat in file_stats.values() if file_stat is not None)
+        self.simulate(REPLAY_REQUEST_SECONDS + upload_bytes / REPLAY_THROUGHPUT + REPLAY_INSTALL_SECONDS + (REPLAY_RESTART_SECONDS if restart else 0), installs=1, restarting_installs=int(restart), restarts=int(restart))
+        return restart
+
+    def post_playground_file(self, data, file_path, folder, restart):
+        file_stat = data['file_index'].stat(file_path)
+        size = file_stat[0] if file_stat is not None else 0
+        self.simulate(REPLAY_REQUEST_SECONDS + size / REPLAY_THROUGHPUT, uploads=1, upload_bytes=size)
+        return ReplayResponse(restart)
+
+    def delete_playground_file(self, data, file_path, folder, restart):
+        self.simulate(REPLAY_REQUEST_SECONDS, deletions=1)
+        return ReplayResponse(restart)
+
+    def wait_for_server(self, playground, task_id, apikey, apiurl, quiet=False):
+        self.simulate(REPLAY_RESTART_SECONDS, restarts=1)
+        return True
+
+    def report(self, replay_metrics):
+        summary = {'trace': self.path, 'events': len(self.events), 'trace_seconds': self.events[-1]['t'] if len(self.events) > 0 else 0.0, 'replay_seconds': round(self.replay_seconds, 3), 'skipped_seconds': round(self.skipped_seconds, 3), 'server_seconds': round(self.server_seconds, 3)}
+        for name in ('batches', 'bulk_batches', 'rescans', 'events_coalesced', 'events_unchanged'):
+            summary[name] = replay_metrics.counters[name]
+        summary.update(self.counts)
+        summary['save_to_live'] = {mode: {'count': len(values), 'p50': round(percentile(values, 0.5), 3), 'p90': round(percentile(values, 0.9), 3), 'max': round(max(values), 3)} for mode, values in sorted(replay_metrics.save_to_live.items())}
+        return summary
+
+
+def write_replay_report(summary, out=None):
+    if out is None:
+        out = sys.stdout
+    out.write(f"\nReplayed {summary['events']} events from {summary['trace']}, spanning {format_seconds(summary['trace_seconds'])}, in {format_seconds(summary['replay_seconds'])} (pauses of {format_seconds(summary['skipped_seconds'])} skipped)\n")
+    out.write(f"  Batches: {summary['batches']} ({summary['bulk_batches']} bulk, {summary['rescans']} rescans); events coalesced: {summary['events_coalesced']}, unchanged: {summary['events_unchanged']}\n")
+    out.write(f"  Full installs: {summary['installs']} ({summary['restarting_installs']} restarting)\n")
+    out.write(f"  Single-file uploads: {summary['uploads']} ({format_bytes(summary['upload_bytes'])}); deletions: {summary['deletions']}\n")
+    out.write(f"  Server restarts: {summary['restarts']}; simulated server time: {format_seconds(summary['server_seconds'])}\n")
+    for mode, values in summary['save_to_live'].items():
+        out.write(f"  Save to live ({mode}): {values['count']} batches, p50 {format_seconds(values['p50'])}, p90 {format_seconds(values['p90'])}, max {format_seconds(values['max'])}\n")
+    out.flush()
+
+
+def replay_trace(args, to_ignore):
+    global metrics
+    replay = TraceReplay(args.replay_trace)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    metrics = ReplayMetrics(args.metrics, args.metrics_format)
+    data = new_watch_data(args, None, None, to_ignore, None)
+    data['replay'] = replay
+    queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+    data['intake'] = EventIntake(queue, loop)
+    consumer = loop.create_task(wait_for_item_in_queue(queue, data))
+    try:
+        # The pipeline's messages would get in the way of a JSON report.
+        with contextlib.redirect_stdout(sys.stderr if args.replay_format == 'json' else sys.stdout):
+            loop.run_until_complete(replay.run(data, queue))
+    finally:
+        consumer.cancel()
+        loop.run_until_complete(asyncio.gather(consumer, return_exceptions=True))
+        loop.close()
+    metrics.flush()
+    summary = replay.report(metrics)
+    if args.replay_format == 'json':
+        json.dump(summary, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        write_replay_report(summary)
+    return 0
+
+
+def git_ignored_paths(directory):
+    if shutil.which("git") is not None:
+        try:
+            ignore_process = subprocess.run(['git', 'ls-files', '-i', '--directory', '-o', '--exclude-standard'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, cwd=directory, check=False)
+            ignore_process.check_returncode()
+            raw_ignore = ignore_process.stdout.splitlines()
+        except:
+            raw_ignore = []
+    else:
+        raw_ignore = []
+    return [path.rstrip('/') for path in raw_ignore]
+
+
+def new_watch_data(args, apikey, apiurl, to_ignore, git_directory):
+    data = {"args": args, "apikey": apikey, "apiurl": apiurl, "to_ignore": [os.path.abspath(os.path.join(args.directory, item)) for item in to_ignore + [SYNC_MANIFEST_FILE]], 'trim': 1 + len(os.path.abspath(args.directory)), 'install_ignore': read_install_ignore(args.directory), 'uploads': {}, 'upload_tasks': set(), 'norestart': args.norestart}
+    data['scheduler'] = InstallScheduler(data)
+    data['background_slots'] = asyncio.Semaphore(BACKGROUND_UPLOADS)
+    data['file_index'] = FileIndex(args.directory, to_ignore, data['install_ignore'])
+    data['git'] = GitActivity(git_directory)
+    return data
+
+
 async def add_manual_event_to_queue(loop, queue):
     await asyncio.sleep(0.01)
-    loop.call_soon_threadsafe(queue.put_nowait, {'event_type': 'manual', 'is_directory': False, 'src_path': '', 'time': time.time()})
+    await queue.put({'event_type': 'manual', 'is_directory': False, 'src_path': '', 'time': time.time()})
 
 async def wait_for_item_in_queue(queue, data):
     while True:
         first_item = await queue.get()
-        asyncio.create_task(handle_event_after_delay(queue, [first_item], data))
+        data['batch_task'] = asyncio.create_task(handle_event_after_delay(queue, [first_item], data))
         await queue.join()
 
 def watch(path: Path, queue: asyncio.Queue, loop: asyncio.BaseEventLoop,
           data: dict, recursive: bool = False) -> None:
     global observer
-    handler = WatchHandler(queue, loop, data, ignore_regexes=data['ignore_regexes'])
+    handler = WatchHandler(queue, loop, data)
     observer = Observer()
     observer.schedule(handler, str(path), recursive=recursive)
     observer.start()
@@ -278,7 +1134,8 @@ def watch(path: Path, queue: asyncio.Queue, loop: asyncio.BaseEventLoop,
     finally:
         observer.stop()
         observer.join()
-    loop.call_soon_threadsafe(queue.put_nowait, None)
+    # The queue is bounded, so wait for room rather than lose the sentinel.
+    loop.call_soon_threadsafe(lambda: asyncio.ensure_future(queue.put(None)))
 
 
 def select_server(env, apiname):
@@ -318,18 +1175,145 @@ def name_from_url(url):
     return name
 
 
-def wait_for_server(playground:bool, task_id, apikey, apiurl):
+class MultipartUpload:
+    """File-like multipart/form-data body that streams a file from disk and reports progress."""
+
+    def __init__(self, fields, file_field, fp, filename, description):
+        self.boundary = binascii.hexlify(os.urandom(16)).decode()
+        head = b''
+        for key, value in fields.items():
+            head += ('--' + self.boundary + '\r\nContent-Disposition: form-data; name="' + key + '"\r\n\r\n' + str(value) + '\r\n').encode('utf-8')
+        head += ('--' + self.boundary + '\r\nContent-Disposition: form-data; name="' + file_field + '"; filename="' + filename.replace('"', '%22') + '"\r\nContent-Type: application/octet-stream\r\n\r\n').encode('utf-8')
+        self.head = head
+        self.tail = ('\r\n--' + self.boundary + '--\r\n').encode('utf-8')
+        self.fp = fp
+        self.fp.seek(0, os.SEEK_END)
+        self.file_size = self.fp.tell()
+        self.description = description
+        self.reset()
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=' + self.boundary
+
+    def __len__(self):
+        return len(self.head) + self.file_size + len(self.tail)
+
+    def __iter__(self):
+        return iter(lambda: self.read(UPLOAD_CHUNK_SIZE), b'')
+
+    def reset(self):
+        self.fp.seek(0)
+        self.sent = 0
+        self.start_time = time.time()
+        self.last_report = self.start_time
+        self.reported = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self)
+        chunk = b''
+        if self.sent < len(self.head):
+            chunk = self.head[self.sent:self.sent + size]
+        if len(chunk) < size and self.sent + len(chunk) < len(self.head) + self.file_size:
+            # Never send more or less of the file than the Content-Length promised, even if the file changes during the upload.
+            wanted = min(size - len(chunk), len(self.head) + self.file_size - self.sent - len(chunk))
+            data = self.fp.read(wanted)
+            if len(data) < wanted:
+                raise TerminalException(self.description + " failed because the file got shorter while it was being uploaded.")
+            chunk += data
+        if len(chunk) < size and self.sent + len(chunk) >= len(self.head) + self.file_size:
+            tail_offset = self.sent + len(chunk) - len(self.head) - self.file_size
+            chunk += self.tail[tail_offset:tail_offset + size - len(chunk)]
+        self.sent += len(chunk)
+        self.report_progress()
+        return chunk
+
+    def report_progress(self):
+        now = time.time()
+        interval = UPLOAD_PROGRESS_INTERVAL if sys.stdout.isatty() else UPLOAD_PROGRESS_INTERVAL_NOTTY
+        if now - self.start_time < UPLOAD_PROGRESS_DELAY or (now - self.last_report < interval and self.sent < len(self)):
+            return
+        self.last_report = now
+        self.reported = True
+        rate = self.sent / max(now - self.start_time, 0.001)
+        sys.stdout.write(f"\r{self.description}: {100.0 * self.sent / len(self):.0f}% of {format_bytes(len(self))} at {format_bytes(rate)}/s" + ("" if sys.stdout.isatty() else "\n"))
+        sys.stdout.flush()
+
+    def finish(self):
+        if self.reported:
+            elapsed = max(time.time() - self.start_time, 0.001)
+            sys.stdout.write(f"\r{self.description}: sent {format_bytes(self.sent)} in {elapsed:.1f}s ({format_bytes(self.sent / elapsed)}/s)\n")
+            sys.stdout.flush()
+
+
+def upload_timeout(size):
+    return UPLOAD_TIMEOUT + size / UPLOAD_MIN_THROUGHPUT
+
+
+def post_with_retries(url, fields, file_field, fp, filename, apikey, description, idempotent):
+    body = MultipartUpload(fields, file_field, fp, filename, description)
+    timeout = upload_timeout(len(body))
+    upload_start = time.time()
+    try:
+        return post_body_with_retries(url, body, timeout, apikey, description, idempotent)
+    finally:
+        history_add_time('transfer', time.time() - upload_start)
+
+
+def post_body_with_retries(url, body, timeout, apikey, description, idempotent):
+    attempt = 0
+    while True:
+        body.reset()
+        try:
+            r = requests.post(url, data=body, headers={'X-API-Key': apikey, 'Content-Type': body.content_type}, timeout=timeout)
+            body.finish()
+            # A proxy can return 502 or 503 after the server has already accepted the request, so only idempotent requests are retried.
+            if r.status_code not in UPLOAD_RETRY_STATUS_CODES or not idempotent:
+                return r
+            problem = "server returned " + str(r.status_code)
+        except requests.exceptions.ConnectionError as err:
+            # Only a connection that failed before any of the body was sent cannot have reached the server.
+            if body.sent > 0 and not idempotent:
+                raise TerminalException("Connection failed after " + description + " had started, so it is not safe to retry; the install may still be in progress on the server. " + str(err))
+            problem = str(err)
+        except requests.exceptions.Timeout:
+            if not idempotent:
+                raise TerminalException("Server timed out after " + description + " was sent, so it is not safe to retry; the install may still be in progress on the server.")
+            problem = "timed out"
+        if attempt >= UPLOAD_RETRIES:
+            raise TerminalException(description + " failed after " + str(attempt + 1) + " attempts: " + problem)
+        delay = UPLOAD_BACKOFF * 2 ** attempt
+        sys.stderr.write(description + " failed (" + problem + "); retrying in " + str(delay) + " seconds\n")
+        time.sleep(delay)
+        attempt += 1
+
+
+def wait_for_server(playground:bool, task_id, apikey, apiurl, quiet=False):
+    wait_start = time.time()
+    try:
+        success = wait_for_task(playground, task_id, apikey, apiurl, quiet)
+    finally:
+        observe_metric('restart_wait_seconds', time.time() - wait_start, playground=playground)
+        history_add_time('server', time.time() - wait_start)
+    if not success:
+        history_set(outcome='failed')
+    return success
+
+
+def wait_for_task(playground:bool, task_id, apikey, apiurl, quiet=False):
+    def progress(text):
+        if not quiet:
+            sys.stdout.write(text)
+            sys.stdout.flush()
     if playground:
-        sys.stdout.write("Waiting for server to restart.")
+        progress("Waiting for server to restart.")
     else:
-        sys.stdout.write("Waiting for package to install.")
-    sys.stdout.flush()
+        progress("Waiting for package to install.")
     time.sleep(1)
-    sys.stdout.write(".")
-    sys.stdout.flush()
+    progress(".")
     time.sleep(1)
-    sys.stdout.write(".")
-    sys.stdout.flush()
+    progress(".")
     time.sleep(1)
     tries = 0
     while tries < 300:
@@ -340,14 +1324,12 @@ def wait_for_server(playground:bool, task_id, apikey, apiurl):
         try:
             r = requests.get(full_url, params={'task_id': task_id}, headers={'X-API-Key': apikey}, timeout=6)
         except requests.exceptions.Timeout:
-            sys.stdout.write(".")
-            sys.stdout.flush()
+            progress(".")
             time.sleep(2)
             tries += 1
             continue
         if r.status_code == 502:
-            sys.stdout.write(".")
-            sys.stdout.flush()
+            progress(".")
             time.sleep(2)
             tries += 1
             continue
@@ -356,8 +1338,7 @@ def wait_for_server(playground:bool, task_id, apikey, apiurl):
         info = r.json()
         if info['status'] == 'completed' or info['status'] == 'unknown':
             break
-        sys.stdout.write(".")
-        sys.stdout.flush()
+        progress(".")
         time.sleep(1)
         tries += 1
     success = False
@@ -380,7 +1361,7 @@ def wait_for_server(playground:bool, task_id, apikey, apiurl):
 
 
 def dainstall():
-    # global full_install_done
+    global metrics
     dotfile = os.path.join(os.path.expanduser('~'), '.docassemblecli')
     parser = argparse.ArgumentParser()
     parser.add_argument("directory", nargs='?')
@@ -395,12 +1376,44 @@ def dainstall():
     parser.add_argument("--add", help="add another server to the .docassemblecli config file", action="store_true")
     parser.add_argument("--noconfig", help="do not use the .docassemblecli config file", action="store_true")
     parser.add_argument("--debug", help="use verbose logging", action="store_true")
+    parser.add_argument("--compression", help="how to compress files in the archive; auto stores files that are already compressed (e.g., DOCX, PDF, PNG, MP4) and deflates everything else", choices=['auto', 'deflate', 'store'], default='auto')
+    parser.add_argument("--compresslevel", help="deflate level from 1 (fastest) to 9 (smallest) (default: 6)", type=int, choices=range(1, 10), default=6, metavar='{1-9}')
+    parser.add_argument("--archive-report", help="report the largest files in the archive, bytes per data folder, and compressed versus raw size", action="store_true")
+    parser.add_argument("--github-url", help="have the server install the package from this git repository instead of uploading the directory")
+    parser.add_argument("--branch", help="with --github-url, the branch to install (default: the default branch of the repository)")
+    parser.add_argument("--pip", help="have the server install this pip requirement (e.g., docassemble.foobar==1.2.0) instead of uploading the directory")
+    parser.add_argument("--skip-ref-check", help="with --github-url, do not check that the remote branch is at the same commit as the local HEAD", action="store_true")
+    parser.add_argument("--nolock", help="do not wait for other dainstall processes on this computer that are installing to the same server", action="store_true")
+    parser.add_argument("--plan", help="report what installing would do (files, archive size, restart, requests, and how --watch would handle uncommitted changes) without installing", action="store_true")
+    parser.add_argument("--plan-format", help="format of the --plan report (default: text)", choices=['text', 'json'], default='text')
+    parser.add_argument("--restart-interval", help="in --watch mode, the minimum number of seconds between installs that restart the server (default: " + str(RESTART_INTERVAL) + ")", type=float, default=RESTART_INTERVAL)
+    parser.add_argument("--metrics", help="in --watch mode, write metrics about the watch pipeline to this file")
+    parser.add_argument("--metrics-format", help="format of the --metrics file: JSON lines (one record per measurement) or a Prometheus text file that is rewritten after each batch (default: jsonl)", choices=['jsonl', 'prometheus'], default='jsonl')
+    parser.add_argument("--manifest", help="only upload the files the package declares in MANIFEST.in and its package data settings, rather than the whole directory", action="store_true")
+    parser.add_argument("--validate", help="parse the YAML of interview files before uploading them, and warn about errors or refuse to upload", choices=['warn', 'error'])
+    parser.add_argument("--record-trace", help="in --watch mode, record the file system events to this file so that they can be replayed with --replay-trace")
+    parser.add_argument("--replay-trace", help="instead of installing, feed the events recorded with --record-trace through the --watch pipeline against a simulated server and report the installs, restarts, and uploads that would result")
+    parser.add_argument("--replay-format", help="format of the --replay-trace report (default: text)", choices=['text', 'json'], default='text')
     args = parser.parse_args()
     if args.norestart and args.force_restart:
         return("The --norestart option can cannot be used with --force-restart.")
     if args.project and not args.playground:
         return("The --project option can only be used with --playground.")
-    if not args.add:
+    if args.metrics and not (args.watch or args.replay_trace):
+        return("The --metrics option can only be used with --watch or --replay-trace.")
+    if args.record_trace and not args.watch:
+        return("The --record-trace option can only be used with --watch.")
+    if args.replay_trace and (args.watch or args.plan or args.github_url or args.pip):
+        return("The --replay-trace option cannot be used with --watch, --plan, --github-url, or --pip.")
+    if args.plan and (args.github_url or args.pip):
+        return("The --plan option cannot be used with --github-url or --pip.")
+    if args.github_url and args.pip:
+        return("The --github-url option cannot be used with --pip.")
+    if args.branch and not args.github_url:
+        return("The --branch option can only be used with --github-url.")
+    if (args.github_url or args.pip) and (args.playground or args.watch):
+        return("The --github-url and --pip options cannot be used with --playground or --watch.")
+    if not args.add and not (args.github_url or args.pip):
         if args.directory is None:
             parser.print_help()
             return(1)
@@ -408,6 +1421,12 @@ def dainstall():
             return(args.directory + " could not be found.")
         if not (os.path.isfile(os.path.join(args.directory, 'setup.py')) or os.path.isfile(os.path.join(args.directory, 'setup.cfg')) or os.path.isfile(os.path.join(args.directory, 'pyproject.toml'))):
             return(args.directory + " does not contain a setup.py, setup.cfg, or pyproject.toml file, so it is not the directory of a Python package.")
+    if args.replay_trace:
+        args.directory = re.sub(r'/$', '', args.directory)
+        try:
+            return replay_trace(args, git_ignored_paths(args.directory))
+        except TerminalException as err:
+            return(str(err))
     used_input = False
     if args.noconfig:
         if args.add:
@@ -477,31 +1496,62 @@ def dainstall():
         add_or_update_env(env, apiurl, apikey)
         if save_dotfile(dotfile, env):
             sys.stdout.write("Saved base URL and API key to .docassemblecli as server " + name_from_url(apiurl) + "\n")
-    args.directory = re.sub(r'/$', '', args.directory)
-    if shutil.which("git") is not None:
+    if args.github_url or args.pip:
         try:
-            ignore_process = subprocess.run(['git', 'ls-files', '-i', '--directory', '-o', '--exclude-standard'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, cwd=args.directory, check=False)
-            ignore_process.check_returncode()
-            raw_ignore = ignore_process.stdout.splitlines()
-        except:
-            raw_ignore = []
-    else:
-        raw_ignore = []
-    to_ignore = [path.rstrip('/') for path in raw_ignore]
+            test_connection(False, apiurl, apikey)
+        except Exception as e:
+            return("Unable to connect to server. " + str(e))
+        try:
+            if args.github_url and not args.skip_ref_check:
+                verify_remote_ref(args.github_url, args.branch, args.directory or '.')
+            do_remote_install(args, apikey, apiurl)
+        except InstallSuperseded:
+            return(0)
+        except TerminalException as err:
+            return(str(err))
+        return(0)
+    args.directory = re.sub(r'/$', '', args.directory)
+    # The server is contacted while the ignored files are listed and the archive is built.
+    preflight = ServerPreflight(apiurl, apikey, args.playground)
+    to_ignore = git_ignored_paths(args.directory)
+    if args.metrics:
+        # The metrics file changes after every batch, so it must neither trigger an install nor be installed.
+        to_ignore += [os.path.abspath(args.metrics), os.path.abspath(args.metrics) + '.tmp']
+    if args.record_trace:
+        to_ignore.append(os.path.abspath(args.record_trace))
     package_name = os.path.basename(os.path.abspath(args.directory))
-    try:
-        test_connection(args.playground, apiurl, apikey)
-    except Exception as e:
-        return("Unable to connect to server. " + str(e))
+    if args.plan:
+        try:
+            plan = plan_install(args, apikey, apiurl, to_ignore, preflight)
+        except TerminalException as err:
+            return(str(err))
+        if args.plan_format == 'json':
+            json.dump(plan, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        else:
+            write_plan(plan)
+        return(0)
     if args.watch:
-        data = {"args": args, "apikey": apikey, "apiurl": apiurl, "to_ignore": [os.path.abspath(os.path.join(args.directory, item)) for item in to_ignore], 'ignore_regexes': IGNORE_REGEXES, 'trim': 1 + len(os.path.abspath(args.directory))}
+        try:
+            preflight.result()
+        except Exception as e:
+            return("Unable to connect to server. " + str(e))
+        data = new_watch_data(args, apikey, apiurl, to_ignore, args.directory)
+        if args.record_trace:
+            try:
+                data['trace'] = TraceRecorder(args.record_trace, args.directory)
+            except OSError as err:
+                return("Unable to write the trace to " + args.record_trace + ": " + str(err))
         # if args.playground:
         #     sys.stdout.write("Doing an initial upload of " + package_name + " to make sure the package is uploaded to the Playground. Subsequent uploads will be incremental.\n")
         #     do_install(data['args'], data['apikey'], data['apiurl'], data['to_ignore'])
         #     full_install_done = True
+        if args.metrics:
+            metrics = WatchMetrics(args.metrics, args.metrics_format)
         sys.stdout.write("Watching " + package_name + " for changes.\n")
         loop = asyncio.get_event_loop()
-        queue = asyncio.Queue()
+        queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        data['intake'] = EventIntake(queue, loop)
         futures = [
             loop.run_in_executor(None, watch, Path(args.directory), queue, loop, data, True),
             wait_for_item_in_queue(queue, data),
@@ -521,10 +1571,15 @@ def dainstall():
             if observer is not None:
                 observer.stop()
             loop.close()
+        if 'trace' in data:
+            data['trace'].close()
+            sys.stdout.write(f"Recorded {data['trace'].count} events to {args.record_trace}.\n")
         sys.stdout.write("\n")
         return(0)
     try:
-        do_install(args, apikey, apiurl, to_ignore)
+        do_install(args, apikey, apiurl, to_ignore, preflight=preflight)
+    except InstallSuperseded:
+        return(0)
     except TerminalException as err:
         return(str(err))
     return(0)
@@ -533,14 +1588,16 @@ def dainstall():
 def dauninstall():
     dotfile = os.path.join(os.path.expanduser('~'), '.docassemblecli')
     parser = argparse.ArgumentParser()
-    parser.add_argument("package")
+    parser.add_argument("package", nargs='+', help="one or more packages to uninstall")
     parser.add_argument("--apiurl", help="base url of your docassemble server, e.g. https://da.example.com")
     parser.add_argument("--apikey", help="docassemble API key")
     parser.add_argument("--norestart", help="do not restart the docassemble server after installing package (only applicable in single-server environments)", action="store_true")
-    parser.add_argument("--server", help="use a particular server from the .docassemblecli config file")
+    parser.add_argument("--server", help="use a particular server from the .docassemblecli config file; can be given more than once to uninstall from several servers at the same time", action="append")
     parser.add_argument("--noconfig", help="do not use the .docassemblecli config file", action="store_true")
+    parser.add_argument("--nolock", help="do not wait for dainstall processes on this computer that are installing to the same server", action="store_true")
     parser.add_argument("--debug", help="use verbose logging", action="store_true")
     args = parser.parse_args()
+    packages = list(collections.OrderedDict.fromkeys(args.package))
     used_input = False
     if args.noconfig:
         env = []
@@ -563,9 +1620,14 @@ def dauninstall():
             env = []
     if args.server:
         try:
-            selected_env = select_server(env, args.server)
+            selected_envs = [select_server(env, server_name) for server_name in collections.OrderedDict.fromkeys(args.server)]
         except TerminalException as err:
             return(str(err))
+        if len(selected_envs) > 1:
+            if args.apiurl or args.apikey:
+                return("The --apiurl and --apikey options cannot be used with more than one --server.")
+            return uninstall_everywhere(args, packages, [{'name': item['name'], 'apiurl': re.sub(r'/+$', '', str(item['apiurl'])), 'apikey': item['apikey']} for item in selected_envs])
+        selected_env = selected_envs[0]
     elif len(env) > 0:
         selected_env = env[0]
     else:
@@ -595,101 +1657,1111 @@ def dauninstall():
         add_or_update_env(env, apiurl, apikey)
         if save_dotfile(dotfile, env):
             sys.stdout.write("Saved base URL and API key to .docassemblecli as server " + name_from_url(apiurl) + "\n")
+    return uninstall_everywhere(args, packages, [{'name': name_from_url(apiurl), 'apiurl': apiurl, 'apikey': apikey}])
+
+
+def uninstall_everywhere(args, packages, servers):
+    if len(servers) == 1:
+        # A single package on a single server is sent to the server as given, which decides whether it is installed.
+        results = uninstall_from_server(args, packages, servers[0], False, len(packages) > 1)
+    else:
+        sys.stdout.write("Uninstalling " + ", ".join(packages) + " from " + ", ".join(server['name'] for server in servers) + ".\n")
+        sys.stdout.flush()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(servers)) as executor:
+            results = [result for server_results in executor.map(lambda server: uninstall_from_server(args, packages, server, True, True), servers) for result in server_results]
+    failures = [result for result in results if result['outcome'] == 'failed']
+    if len(results) == 1:
+        if len(failures) > 0:
+            return(failures[0]['detail'])
+        if results[0]['outcome'] == 'not installed':
+            return(results[0]['package'] + " is not installed on " + results[0]['server'] + ".")
+        return(0)
+    write_uninstall_report(results)
+    if len(failures) > 0:
+        return("Unable to complete " + str(len(failures)) + " of " + str(len(results)) + " steps.")
+    return(0)
+
+
+def uninstall_from_server(args, packages, server, quiet, check_installed):
+    """Uninstalls packages from one server, restarting it at most once.
+
+    Every package but the last is uninstalled without a restart, and
+    the last one restarts the server. If the last one cannot be
+    uninstalled, the server is restarted separately. With
+    check_installed, packages that the server does not list as
+    installed are reported and skipped.
+    """
+    apiurl = server['apiurl']
+    apikey = server['apikey']
+    results = []
+
+    def report(package, outcome, detail='', seconds=None):
+        results.append({'server': server['name'], 'package': package, 'outcome': outcome, 'detail': detail, 'seconds': seconds})
+        if quiet:
+            sys.stdout.write("[" + server['name'] + "] " + (package or 'restart') + ": " + outcome + ((" (" + detail + ")") if detail else '') + "\n")
+            sys.stdout.flush()
+
+    if not check_installed:
+        return uninstall_with_lock(args, packages, server, quiet, report, results)
     try:
-        test_connection(False, apiurl, apikey)
-    except Exception as e:
-        return("Unable to connect to server. " + str(e))
-    data = {'package': args.package}
-    if args.norestart:
-        data['restart'] = '0'
-    try:
-        r = requests.delete(apiurl + '/api/package', params=data, headers={'X-API-Key': apikey}, timeout=50)
-        if r.status_code != 200:
-            raise TerminalException("package DELETE returned " + str(r.status_code) + ": " + r.text)
-        info = r.json()
-        task_id = info['task_id']
-        if wait_for_server(False, task_id, apikey, apiurl):
-            sys.stdout.write("\nUninstalled.\n")
+        installed_packages = get_server_info(ServerPreflight(apiurl, apikey, False))['packages']
     except TerminalException as err:
-        return(str(err))
-    return(0)
+        for package in packages:
+            report(package, 'failed', str(err))
+        return results
+    installed_names = {}
+    for package_info in installed_packages:
+        installed_names[package_info['name']] = package_info['name']
+        installed_names[re.sub(r'^docassemble\.', 'docassemble-', package_info['name'])] = package_info['name']
+    to_remove = []
+    for package in packages:
+        if package in installed_names:
+            to_remove.append(installed_names[package])
+        elif 'docassemble.' + package in installed_names:
+            to_remove.append(installed_names['docassemble.' + package])
+        else:
+            report(package, 'not installed')
+    if len(to_remove) == 0:
+        return results
+    return uninstall_with_lock(args, list(collections.OrderedDict.fromkeys(to_remove)), server, quiet, report, results)
+
+
+def uninstall_with_lock(args, packages, server, quiet, report, results):
+    if args.nolock:
+        uninstall_packages(args, packages, server, quiet, report)
+    else:
+        with InstallCoordinator(server['apiurl'], 'uninstall of ' + ', '.join(packages)):
+            uninstall_packages(args, packages, server, quiet, report)
+    return results
+
+
+def uninstall_packages(args, packages, server, quiet, report):
+    apiurl = server['apiurl']
+    apikey = server['apikey']
+    restart_needed = False
+    with HistoryRecord('dauninstall', apiurl, ', '.join(packages), 'server'):
+        history_set(restart=not args.norestart, restart_reason='not requested' if args.norestart else 'uninstall')
+        for index, package in enumerate(packages):
+            last = index == len(packages) - 1
+            data = {'package': package}
+            if args.norestart or not last:
+                data['restart'] = '0'
+            if not quiet and len(packages) > 1:
+                sys.stdout.write("Uninstalling " + package + ".\n")
+                sys.stdout.flush()
+            start_time = time.time()
+            try:
+                r = requests.delete(apiurl + '/api/package', params=data, headers={'X-API-Key': apikey}, timeout=50)
+                if r.status_code != 200:
+                    raise TerminalException("package DELETE returned " + str(r.status_code) + ": " + r.text)
+                info = r.json()
+                task_id = info['task_id']
+                success = wait_for_server(False, task_id, apikey, apiurl, quiet)
+            except (TerminalException, requests.exceptions.RequestException) as err:
+                report(package, 'failed', str(err), time.time() - start_time)
+                history_set(outcome='failed', error=str(err))
+                continue
+            if success:
+                if not quiet:
+                    sys.stdout.write("\nUninstalled.\n")
+                report(package, 'uninstalled', seconds=time.time() - start_time)
+                # The last package restarts the server, which covers the packages before it.
+                restart_needed = not args.norestart and not last
+            else:
+                report(package, 'failed', "the server reported a problem", time.time() - start_time)
+        if restart_needed:
+            start_time = time.time()
+            try:
+                r = requests.post(apiurl + '/api/restart', headers={'X-API-Key': apikey}, timeout=50)
+                if r.status_code != 200:
+                    raise TerminalException("restart POST returned " + str(r.status_code) + ": " + r.text)
+                success = wait_for_server(True, r.json()['task_id'], apikey, apiurl, quiet)
+            except (TerminalException, requests.exceptions.RequestException) as err:
+                report(None, 'failed', str(err), time.time() - start_time)
+                return
+            report(None, 'restarted' if success else 'failed', seconds=time.time() - start_time)
+
+
+def write_uninstall_report(results, out=None):
+    if out is None:
+        out = sys.stdout
+    out.write("\nSummary:\n")
+    server_width = max(len(result['server']) for result in results)
+    package_width = max(len(result['package'] or '(restart)') for result in results)
+    for result in results:
+        line = f"  {result['server']:<{server_width}}  {result['package'] or '(restart)':<{package_width}}  {result['outcome']}"
+        if result['seconds'] is not None:
+            line += f" in {result['seconds']:.1f} seconds"
+        if result['detail']:
+            line += ": " + result['detail']
+        out.write(line + "\n")
+    out.flush()
+
+
+class ServerPreflight:
+    """Asks the server what an install needs to know, in background threads.
+
+    This checks the API key, gets the list of installed packages, and,
+    for the Playground, gets the list of projects. The requests run at
+    the same time as each other and as whatever the caller does next,
+    such as building the archive; result() waits for them.
+    """
+
+    def __init__(self, apiurl, apikey, playground):
+        self.apiurl = apiurl
+        self.apikey = apikey
+        self.start = time.time()
+        self.request_seconds = 0.0
+        self.lock = threading.Lock()
+        self.finished = None
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self.futures = {'packages': executor.submit(self.get_packages)}
+        if playground:
+            self.futures['projects'] = executor.submit(self.get_projects)
+        executor.shutdown(wait=False)
+
+    def get(self, path):
+        request_start = time.time()
+        try:
+            return requests.get(self.apiurl + path, headers={'X-API-Key': self.apikey}, timeout=50)
+        finally:
+            with self.lock:
+                self.request_seconds += time.time() - request_start
+
+    def get_packages(self):
+        r = self.get('/api/package')
+        if r.status_code == 403:
+            raise RuntimeError("Please verify the validity of your API-Key.")
+        if r.status_code != 200:
+            raise RuntimeError(f"Server responded with status code {r.status_code}.")
+        return r.json()
+
+    def get_projects(self):
+        r = self.get('/api/playground/project')
+        if r.status_code != 200:
+            raise RuntimeError("Please check if 'enable playground' is set to 'True' in server configuration.")
+        return r.json()
+
+    def result(self):
+        info = {name: future.result() for name, future in self.futures.items()}
+        if self.finished is None:
+            self.finished = time.time()
+        return info
+
+    def seconds_saved(self, busy_until):
+        """Returns how much sooner the requests and the work the caller did until busy_until finished than if they had run one after the other."""
+        return max(0.0, (busy_until - self.start) + self.request_seconds - (max(self.finished, busy_until) - self.start))
+
+
+def test_connection(playground, apiurl, apikey):
+    ServerPreflight(apiurl, apikey, playground).result()
+
+def is_already_compressed(file_path):
+    if os.path.splitext(file_path)[1].lower() in STORED_EXTENSIONS:
+        return True
+    try:
+        with open(file_path, 'rb') as fp:
+            header = fp.read(16)
+    except OSError:
+        return False
+    for magic_number in COMPRESSED_MAGIC_NUMBERS:
+        if header.startswith(magic_number):
+            return True
+    if header[4:8] == b'ftyp':  # MP4, MOV, M4A and related containers
+        return True
+    return False
+
+
+def compression_for_file(file_path, policy):
+    if policy == 'store':
+        return zipfile.ZIP_STORED
+    if policy == 'deflate':
+        return zipfile.ZIP_DEFLATED
+    if is_already_compressed(file_path):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024 or unit == 'GB':
+            break
+        size /= 1024.0
+    if unit == 'B':
+        return f"{int(size)} {unit}"
+    return f"{size:.1f} {unit}"
+
+
+def folder_of_archive_entry(filename):
+    m = re.search(r'(^|/)docassemble/[^/]+/data/([^/]+)/', filename)
+    if m:
+        return m.group(2)
+    if re.search(r'(^|/)docassemble/[^/]+/[^/]+\.py$', filename):
+        return 'modules'
+    return 'other'
+
+
+def write_archive_report(entries, out=None):
+    if out is None:
+        out = sys.stdout
+    total_raw = sum(info.file_size for info in entries)
+    total_compressed = sum(info.compress_size for info in entries)
+    ratio = (100.0 * total_compressed / total_raw) if total_raw else 100.0
+    out.write("Archive report:\n")
+    out.write(f"  {len(entries)} files, {format_bytes(total_raw)} raw, {format_bytes(total_compressed)} compressed ({ratio:.1f}% of raw)\n")
+    by_folder = {}
+    for info in entries:
+        folder = folder_of_archive_entry(info.filename)
+        if folder not in by_folder:
+            by_folder[folder] = {'files': 0, 'raw': 0, 'compressed': 0}
+        by_folder[folder]['files'] += 1
+        by_folder[folder]['raw'] += info.file_size
+        by_folder[folder]['compressed'] += info.compress_size
+    out.write("  By folder:\n")
+    for folder, totals in sorted(by_folder.items(), key=lambda item: -item[1]['compressed']):
+        out.write(f"    {folder:<12} {totals['files']:>6} files {format_bytes(totals['raw']):>10} raw {format_bytes(totals['compressed']):>10} compressed\n")
+    out.write("  Largest files:\n")
+    for info in sorted(entries, key=lambda item: -item.compress_size)[:ARCHIVE_REPORT_LIMIT]:
+        method = 'stored' if info.compress_type == zipfile.ZIP_STORED else 'deflated'
+        out.write(f"    {format_bytes(info.compress_size):>10} {method:<8} {info.filename}\n")
+    out.flush()
+
+
+def glob_to_regex(pattern):
+    result = ''
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern[i:i + 3] == '**/':
+            result += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern[i:i + 2] == '**':
+            result += '.*'
+            i += 2
+            continue
+        if char == '*':
+            result += '[^/]*'
+        elif char == '?':
+            result += '[^/]'
+        elif char == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                result += re.escape(char)
+            else:
+                content = pattern[i + 1:end]
+                if content.startswith('!'):
+                    content = '^' + content[1:]
+                result += '[' + content.replace('\\', '\\\\') + ']'
+                i = end
+        else:
+            result += re.escape(char)
+        i += 1
+    return result
+
+
+def read_install_ignore(directory):
+    patterns = []
+    try:
+        with open(os.path.join(directory, INSTALL_IGNORE_FILE), 'r', encoding='utf-8') as fp:
+            lines = fp.read().splitlines()
+    except OSError:
+        return patterns
+    for line in lines:
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        negated = line.startswith('!')
+        if negated:
+            line = line[1:]
+        directory_only = line.endswith('/')
+        line = line.rstrip('/')
+        if line.startswith('/') or '/' in line:
+            regex = glob_to_regex(line.lstrip('/'))
+        else:
+            regex = '(?:.*/)?' + glob_to_regex(line)
+        patterns.append({'self': re.compile('^' + regex + '$'), 'under': re.compile('^' + regex + '/'), 'negated': negated, 'directory_only': directory_only})
+    return patterns
+
+
+def path_is_ignored(relative_path, patterns, is_directory=False):
+    ignored = False
+    for pattern in patterns:
+        if pattern['under'].match(relative_path) or (pattern['self'].match(relative_path) and (is_directory or not pattern['directory_only'])):
+            ignored = not pattern['negated']
+    return ignored
+
+
+def read_package_data_rules(directory):
+    rules = {'package_data': {}, 'exclude_package_data': {}}
+    pyproject_path = os.path.join(directory, 'pyproject.toml')
+    if os.path.isfile(pyproject_path):
+        with open(pyproject_path, 'rb') as fp:
+            data = tomli.load(fp)
+        setuptools_config = data.get('tool', {}).get('setuptools', {})
+        for key, toml_key in (('package_data', 'package-data'), ('exclude_package_data', 'exclude-package-data')):
+            if isinstance(setuptools_config.get(toml_key, None), dict):
+                for package, globs in setuptools_config[toml_key].items():
+                    rules[key].setdefault(package, []).extend(globs)
+    setup_cfg_path = os.path.join(directory, 'setup.cfg')
+    if os.path.isfile(setup_cfg_path):
+        config = configparser.ConfigParser()
+        try:
+            config.read(setup_cfg_path, encoding='utf-8')
+        except configparser.Error:
+            return rules
+        for key, section in (('package_data', 'options.package_data'), ('exclude_package_data', 'options.exclude_package_data')):
+            if config.has_section(section):
+                for package, value in config.items(section):
+                    rules[key].setdefault(package, []).extend(item.strip() for item in re.split(r'[,\n]', value) if item.strip())
+    return rules
+
+
+def package_data_matches(relative_path, package_dir, globs):
+    remainder = relative_path[len(package_dir) + 1:] if package_dir else relative_path
+    for glob in globs:
+        if re.match('^' + glob_to_regex(glob) + '$', remainder):
+            return True
+    return False
+
+
+def declared_package_files(directory, candidates):
+    package_dirs = set(posixpath.dirname(path) for path in candidates if posixpath.basename(path) == '__init__.py')
+
+    def package_dir_of(path):
+        parent = posixpath.dirname(path)
+        while parent:
+            if parent in package_dirs:
+                return parent
+            parent = posixpath.dirname(parent)
+        return None
+
+    rules = read_package_data_rules(directory)
+    has_manifest = os.path.isfile(os.path.join(directory, 'MANIFEST.in'))
+    declared = set()
+    for path in candidates:
+        if '/' not in path and re.search(r'^(setup\.py|setup\.cfg|pyproject\.toml|MANIFEST\.in|(README|LICENSE|LICENCE|COPYING|NOTICE|AUTHORS)(\..*)?)$', path):
+            declared.add(path)
+            continue
+        package_dir = package_dir_of(path)
+        if package_dir is None:
+            continue
+        if path.endswith('.py') and posixpath.dirname(path) in package_dirs:
+            declared.add(path)
+            continue
+        package = package_dir.replace('/', '.')
+        if len(rules['package_data']) > 0:
+            if package_data_matches(path, package_dir, rules['package_data'].get(package, []) + rules['package_data'].get('*', []) + rules['package_data'].get('', [])):
+                declared.add(path)
+        elif not has_manifest:
+            declared.add(path)
+    if has_manifest:
+        with open(os.path.join(directory, 'MANIFEST.in'), 'r', encoding='utf-8') as fp:
+            manifest_lines = fp.read().splitlines()
+        for line in manifest_lines:
+            words = line.split('#', 1)[0].split()
+            if len(words) < 2:
+                continue
+            command = words[0]
+            if command in ('include', 'exclude'):
+                regexes = ['^' + glob_to_regex(pattern) + '$' for pattern in words[1:]]
+            elif command in ('recursive-include', 'recursive-exclude') and len(words) >= 3:
+                prefix = '' if words[1] in ('*', '.') else glob_to_regex(words[1].strip('/')) + '/'
+                regexes = ['^' + prefix + '(?:.*/)?' + glob_to_regex(pattern) + '$' for pattern in words[2:]]
+            elif command in ('global-include', 'global-exclude'):
+                regexes = ['^(?:.*/)?' + glob_to_regex(pattern) + '$' for pattern in words[1:]]
+            elif command in ('graft', 'prune'):
+                regexes = ['^' + glob_to_regex(pattern.strip('/')) + '/' for pattern in words[1:]]
+            else:
+                sys.stderr.write("Ignoring unrecognized line in MANIFEST.in: " + line + "\n")
+                continue
+            matching = set(path for path in candidates if any(re.match(regex, path) for regex in regexes))
+            if command in ('include', 'recursive-include', 'global-include', 'graft'):
+                declared |= matching
+            else:
+                declared -= matching
+    for path in list(declared):
+        package_dir = package_dir_of(path)
+        if package_dir is None:
+            continue
+        package = package_dir.replace('/', '.')
+        if package_data_matches(path, package_dir, rules['exclude_package_data'].get(package, []) + rules['exclude_package_data'].get('*', []) + rules['exclude_package_data'].get('', [])):
+            declared.discard(path)
+    return declared
+
+
+def try_lock(fp):
+    try:
+        if fcntl is not None:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            fp.seek(0)
+            msvcrt.locking(fp.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def unlock(fp):
+    if fcntl is not None:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+    else:
+        fp.seek(0)
+        msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def process_is_alive(pid):
+    if os.name == 'nt':
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            # Access is denied to processes that exist but belong to someone else.
+            return kernel32.GetLastError() == 5
+        try:
+            exit_code = ctypes.c_ulong()
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+                return True
+            return exit_code.value == 259  # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class InstallCoordinator:
+    """Makes dainstall processes on this computer take turns installing to the same server.
+
+    Each server has a lock file, which is held for the duration of an
+    install, and a queue file listing the processes that are waiting.
+    A process that is waiting gives up its turn if a process on the
+    same computer that queued later is installing the same package from
+    the same source, because that later install will replace the
+    package anyway.
+    """
+
+    def __init__(self, apiurl, package_name, source=None):
+        self.server = name_from_url(apiurl)
+        lock_dir = os.environ.get('DOCASSEMBLECLI_LOCKDIR') or os.path.join(os.path.expanduser('~'), '.docassemblecli_locks')
+        base_name = re.sub(r'[^A-Za-z0-9_.\-]', '_', self.server)
+        self.lock_dir = lock_dir
+        self.lock_path = os.path.join(lock_dir, base_name + '.lock')
+        self.queue_path = os.path.join(lock_dir, base_name + '.queue')
+        self.entry = {'id': binascii.hexlify(os.urandom(8)).decode(), 'pid': os.getpid(), 'package': package_name, 'source': source, 'host': socket.gethostname(), 'since': time.time(), 'state': 'waiting'}
+        self.superseded_by = None
+        self.fp = None
+
+    def update_queue(self, change=None):
+        with open(self.queue_path + '.lock', 'a+') as queue_lock:
+            while not try_lock(queue_lock):
+                time.sleep(0.05)
+            try:
+                try:
+                    with open(self.queue_path, 'r', encoding='utf-8') as fp:
+                        queue = json.load(fp)
+                except (OSError, ValueError):
+                    queue = []
+                queue = [item for item in queue if process_is_alive(item['pid'])]
+                if change == 'add':
+                    if self.entry['id'] not in [item['id'] for item in queue]:
+                        queue.append(self.entry)
+                else:
+                    queue = [item for item in queue if item['id'] != self.entry['id']]
+                    if change == 'installing':
+                        self.entry['state'] = 'installing'
+                        queue.insert(0, self.entry)
+                with open(self.queue_path, 'w', encoding='utf-8') as fp:
+                    json.dump(queue, fp)
+            finally:
+                unlock(queue_lock)
+        return queue
+
+    def __enter__(self):
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self.update_queue('add')
+        self.fp = open(self.lock_path, 'a+')
+        start_time = time.time()
+        announced_position = None
+        try:
+            while not try_lock(self.fp):
+                queue = self.update_queue('add')
+                position = [item['id'] for item in queue].index(self.entry['id'])
+                newer = [item for item in queue[position + 1:] if item['package'] == self.entry['package'] and item.get('source') == self.entry['source'] and item.get('host') == self.entry['host']]
+                if len(newer) > 0:
+                    self.superseded_by = newer[-1]
+                    break
+                if position != announced_position:
+                    installing = [item for item in queue if item['state'] == 'installing']
+                    sys.stdout.write("Waiting for " + (installing[0]['package'] + " (process " + str(installing[0]['pid']) + ")" if len(installing) > 0 else "another install") + " to finish installing on " + self.server + "; this install is number " + str(position + 1) + " in the queue.\n")
+                    sys.stdout.flush()
+                    announced_position = position
+                time.sleep(LOCK_POLL_INTERVAL)
+        except BaseException:
+            self.release()
+            raise
+        self.wait_time = time.time() - start_time
+        if self.superseded_by is not None:
+            self.release()
+            sys.stdout.write("Not installing, because process " + str(self.superseded_by['pid']) + " queued a newer install of " + self.entry['package'] + " to " + self.server + f" (waited {self.wait_time:.1f} seconds).\n")
+            sys.stdout.flush()
+            return self
+        self.update_queue('installing')
+        if announced_position is not None:
+            sys.stdout.write(f"Waited {self.wait_time:.1f} seconds for other installs to {self.server} to finish.\n")
+            sys.stdout.flush()
+        return self
+
+    def release(self):
+        self.update_queue()
+        if self.fp is not None:
+            if self.superseded_by is None:
+                try:
+                    unlock(self.fp)
+                except OSError:
+                    pass
+            self.fp.close()
+            self.fp = None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+def history_path():
+    path = os.environ.get('DOCASSEMBLECLI_HISTORY')
+    if path is None:
+        return os.path.join(os.path.expanduser('~'), '.docassemblecli_history.sqlite')
+    if path.strip() == '' or path.strip().lower() == 'off':
+        return None
+    return path
+
+
+def open_history(path):
+    conn = sqlite3.connect(path, timeout=HISTORY_TIMEOUT)
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, " + ", ".join(name + " " + kind for name, kind in HISTORY_COLUMNS.items()) + ")")
+        conn.execute("CREATE INDEX IF NOT EXISTS runs_by_package ON runs (command, server, package, started)")
+    return conn
+
+
+def save_history(fields):
+    path = history_path()
+    if path is None:
+        return
+    try:
+        conn = open_history(path)
+        try:
+            with conn:
+                conn.execute("INSERT INTO runs (" + ", ".join(fields.keys()) + ") VALUES (" + ", ".join('?' for name in fields) + ")", list(fields.values()))
+        finally:
+            conn.close()
+    except sqlite3.Error as err:
+        sys.stderr.write("Unable to record this run in " + path + ": " + str(err) + "\n")
+
+
+class HistoryRecord:
+    """Records one install, uninstall, or download in the history database.
+
+    While the record is open, history_set() and history_add_time() in
+    the same thread add to it. The record is saved when it is closed,
+    with an outcome of "failed" if an exception was raised.
+    """
+
+    def __init__(self, command, apiurl, package, mode):
+        self.fields = {name: None for name in HISTORY_COLUMNS}
+        self.fields.update({'started': time.time(), 'command': command, 'server': name_from_url(apiurl), 'package': history_package_name(package), 'mode': mode})
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = getattr(history_local, 'record', None)
+        history_local.record = self
+        return self
 
-def test_connection(playground, apiurl, apikey):
-    general_test_response = requests.get(apiurl + '/api/package', headers={'X-API-Key': apikey}, timeout=50)
-    if general_test_response.status_code == 403:
-        raise RuntimeError("Please verify the validity of your API-Key.")
-    if general_test_response.status_code != 200:
-        raise RuntimeError(f"Server responded with status code {general_test_response.status_code}.")
-    if not playground:
-        return
-    playground_test_response = requests.get(apiurl + '/api/playground/project', headers={'X-API-Key': apikey}, timeout=50)
-    if playground_test_response.status_code != 200:
-        raise RuntimeError("Please check if 'enable playground' is set to 'True' in server configuration.")
-    return
+    def __exit__(self, exc_type, exc_value, traceback):
+        history_local.record = self.previous
+        if exc_type is not None:
+            if issubclass(exc_type, (KeyboardInterrupt, GracefulExit)):
+                self.fields['outcome'] = 'interrupted'
+            elif issubclass(exc_type, InstallSuperseded):
+                self.fields['outcome'] = 'superseded'
+            else:
+                self.fields['outcome'] = 'failed'
+                self.fields['error'] = str(exc_value).strip()
+        elif self.fields['outcome'] is None:
+            self.fields['outcome'] = 'success'
+        if self.fields['restart'] is not None:
+            self.fields['restart'] = int(self.fields['restart'])
+        self.fields['total_seconds'] = time.time() - self.fields['started']
+        save_history(self.fields)
+        return False
+
+
+def history_package_name(package):
+    if package is None:
+        return None
+    return re.sub(r'^docassemble-', 'docassemble.', package.lower())
+
+
+def history_set(**fields):
+    if 'package' in fields:
+        fields['package'] = history_package_name(fields['package'])
+    record = getattr(history_local, 'record', None)
+    if record is not None:
+        record.fields.update(fields)
+
+
+def history_add_time(phase, seconds):
+    record = getattr(history_local, 'record', None)
+    if record is not None:
+        record.fields[phase + '_seconds'] = (record.fields[phase + '_seconds'] or 0.0) + seconds
+
+
+def relative_ignore_paths(directory, to_ignore):
+    result = set()
+    for item in to_ignore:
+        if os.path.isabs(item):
+            item = os.path.relpath(item, os.path.abspath(directory))
+        result.add('/'.join(os.path.normpath(item).split(os.sep)))
+    return result
+
+
+def directory_is_excluded(name, relative_path, ignore_paths, install_ignore):
+    if name in IGNORE_DIRS or name.startswith('flycheck_') or name.endswith('.egg-info') or relative_path in ignore_paths:
+        return True
+    return len(install_ignore) > 0 and path_is_ignored(relative_path, install_ignore, is_directory=True)
+
+
+def path_is_watch_ignored(path):
+    path = os.path.abspath(path)
+    return any(pattern.match(path) for pattern in IGNORE_PATTERNS)
+
+
+def file_is_excluded(name, relative_path, ignore_paths, install_ignore):
+    if name.endswith('~') or name.endswith('.pyc') or name.endswith('.swp') or name.startswith('#') or name.startswith('.#') or name.startswith('.flycheck_') or (name in ('.gitignore', INSTALL_IGNORE_FILE, SYNC_MANIFEST_FILE) and relative_path == name) or relative_path in ignore_paths:
+        return True
+    return len(install_ignore) > 0 and path_is_ignored(relative_path, install_ignore)
+
+
+def find_git_dir(directory):
+    current = os.path.abspath(directory)
+    while True:
+        candidate = os.path.join(current, '.git')
+        if os.path.isdir(candidate):
+            return candidate
+        if os.path.isfile(candidate):
+            # Worktrees and submodules have a .git file that points to the real git directory.
+            try:
+                with open(candidate, 'r', encoding='utf-8') as fp:
+                    m = re.match(r'gitdir:\s*(.*)', fp.read().strip())
+            except OSError:
+                m = None
+            if m:
+                return os.path.normpath(os.path.join(current, m.group(1)))
+            return None
+        parent = os.path.dirname(current)
+        if parent == current:
+            return None
+        current = parent
+
+
+class GitActivity:
+    """Tells whether git is changing the working tree of the watched package.
+
+    git holds index.lock while a checkout, merge, reset, or stash is
+    rewriting files, and HEAD, the current branch, and the index change
+    as each step of an operation, such as a commit being replayed by a
+    rebase, finishes. A rebase that is paused on a conflict is not an
+    operation in progress, because the files are then being edited.
+    """
+
+    def __init__(self, directory):
+        self.git_dir = find_git_dir(directory) if directory is not None else None
+
+    def operation(self):
+        if self.git_dir is None:
+            return None
+        if os.path.exists(os.path.join(self.git_dir, 'index.lock')) or os.path.exists(os.path.join(self.git_dir, 'HEAD.lock')):
+            return "a git operation"
+        return None
+
+    def seconds_since_change(self):
+        if self.git_dir is None:
+            return float('inf')
+        paths = [os.path.join(self.git_dir, name) for name in ('HEAD', 'index', 'ORIG_HEAD')]
+        try:
+            with open(paths[0], 'r', encoding='utf-8') as fp:
+                m = re.match(r'ref:\s*(\S+)', fp.read())
+            if m:
+                paths.append(os.path.join(self.git_dir, *m.group(1).split('/')))
+        except OSError:
+            pass
+        latest = 0.0
+        for path in paths:
+            try:
+                latest = max(latest, os.stat(path).st_mtime)
+            except OSError:
+                pass
+        return time.time() - latest
+
+
+class FileIndex:
+    """The files of a package directory that belong in its archive, with their sizes and modification times.
+
+    The index is built once with os.scandir() and then kept up to date
+    from watchdog events, so that installs in --watch mode do not need
+    to walk the directory tree again.
+    """
+
+    def __init__(self, directory, to_ignore, install_ignore):
+        self.directory = os.path.abspath(directory)
+        self.ignore_paths = relative_ignore_paths(directory, to_ignore)
+        self.install_ignore = install_ignore
+        self.lock = threading.Lock()
+        self.files = {}
+        self.rescan()
+
+    def scan(self, relative_dir):
+        found = {}
+        stack = [relative_dir]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(os.path.join(self.directory, *current.split('/')) if current else self.directory) as entries:
+                    for entry in entries:
+                        relative_path = current + '/' + entry.name if current else entry.name
+                        if path_is_watch_ignored(entry.path):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            if not directory_is_excluded(entry.name, relative_path, self.ignore_paths, self.install_ignore):
+                                stack.append(relative_path)
+                        elif not file_is_excluded(entry.name, relative_path, self.ignore_paths, self.install_ignore):
+                            try:
+                                entry_stat = entry.stat()
+                            except FileNotFoundError:
+                                continue
+                            found[relative_path] = (entry_stat.st_size, entry_stat.st_mtime_ns)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        return found
+
+    def rescan(self):
+        found = self.scan('')
+        with self.lock:
+            self.files = found
+
+    def relative_path(self, path):
+        relative_path = os.path.relpath(os.path.abspath(path), self.directory)
+        if relative_path.startswith('..'):
+            return None
+        return '/'.join(relative_path.split(os.sep))
+
+    def is_excluded(self, relative_path, is_directory):
+        if path_is_watch_ignored(os.path.join(self.directory, *relative_path.split('/'))):
+            return True
+        parts = relative_path.split('/')
+        for index in range(len(parts) - 1):
+            if directory_is_excluded(parts[index], '/'.join(parts[:index + 1]), self.ignore_paths, self.install_ignore):
+                return True
+        if is_directory:
+            return directory_is_excluded(parts[-1], relative_path, self.ignore_paths, self.install_ignore)
+        return file_is_excluded(parts[-1], relative_path, self.ignore_paths, self.install_ignore)
+
+    def update(self, path, event_type, is_directory):
+        relative_path = self.relative_path(path)
+        if relative_path is None or relative_path == '.' or self.is_excluded(relative_path, is_directory):
+            return
+        if is_directory:
+            found = self.scan(relative_path) if event_type != 'deleted' else {}
+            with self.lock:
+                for existing_path in [item for item in self.files if item.startswith(relative_path + '/')]:
+                    del self.files[existing_path]
+                self.files.update(found)
+            return
+        if event_type != 'deleted':
+            try:
+                file_stat = os.stat(path)
+                with self.lock:
+                    self.files[relative_path] = (file_stat.st_size, file_stat.st_mtime_ns)
+                return
+            except FileNotFoundError:
+                pass
+        with self.lock:
+            self.files.pop(relative_path, None)
 
-def do_install(args, apikey, apiurl, to_ignore):
+    def stat(self, path):
+        relative_path = self.relative_path(path)
+        with self.lock:
+            return self.files.get(relative_path, None)
+
+    def paths(self):
+        with self.lock:
+            return sorted(self.files)
+
+    def set_stat(self, path, file_stat):
+        relative_path = self.relative_path(path)
+        if relative_path is None or relative_path == '.' or self.is_excluded(relative_path, False):
+            return
+        with self.lock:
+            if file_stat is None:
+                self.files.pop(relative_path, None)
+            else:
+                self.files[relative_path] = tuple(file_stat)
+
+
+def read_package_metadata(root, files):
+    this_package_name = None
+    dependencies = {}
+    if 'pyproject.toml' in files:
+        with open(os.path.join(root, 'pyproject.toml'), 'rb') as fp:
+            data = tomli.load(fp)
+            if 'project' not in data:
+                raise TerminalException("The pyproject.toml file did not contain a project section")
+            if 'name' not in data['project']:
+                raise TerminalException("The pyproject.toml file did not contain the package name")
+            this_package_name = data['project']['name']
+            if 'dependencies' in data['project'] and isinstance(data['project']['dependencies'], list):
+                for dependency_string in data['project']['dependencies']:
+                    mm = re.search(r'(.*)(<=|>=|==|<|>)(.*)', dependency_string)
+                    if mm:
+                        dependencies[mm.group(1).strip()] = {'installed': False, 'operator': mm.group(2), 'version': mm.group(3).strip()}
+                    else:
+                        dependencies[dependency_string] = {'installed': False, 'operator': None, 'version': None}
+    if 'setup.py' in files:
+        with open(os.path.join(root, 'setup.py'), 'r', encoding='utf-8') as fp:
+            setup_text = fp.read()
+            m = re.search(r'setup\(.*\bname=(["\'])(.*?)(["\'])', setup_text)
+            if m and m.group(1) == m.group(3):
+                this_package_name = m.group(2).strip()
+            m = re.search(r'setup\(.*install_requires=\[(.*?)\]', setup_text, flags=re.DOTALL)
+            if m:
+                for package_text in m.group(1).split(','):
+                    package_name = package_text.strip()
+                    if len(package_name) >= 3 and package_name[0] == package_name[-1] and package_name[0] in ("'", '"'):
+                        package_name = package_name[1:-1]
+                        mm = re.search(r'(.*)(<=|>=|==|<|>)(.*)', package_name)
+                        if mm:
+                            dependencies[mm.group(1).strip()] = {'installed': False, 'operator': mm.group(2), 'version': mm.group(3).strip()}
+                        else:
+                            dependencies[package_name] = {'installed': False, 'operator': None, 'version': None}
+    return this_package_name, dependencies
+
+
+def build_archive(args, to_ignore, file_index=None):
     archive = tempfile.NamedTemporaryFile(suffix=".zip")
-    zf = zipfile.ZipFile(archive, compression=zipfile.ZIP_DEFLATED, mode='w')
+    zf = zipfile.ZipFile(archive, compression=zipfile.ZIP_DEFLATED, compresslevel=args.compresslevel, mode='w')
     root_directory = None
     has_python_files = False
     this_package_name = None
     dependencies = {}
-    for root, dirs, files in os.walk(args.directory, topdown=True):
-        adjusted_root = os.sep.join(root.split(os.sep)[1:])
-        dirs[:] = [d for d in dirs if d not in IGNORE_DIRS and not d.startswith('flycheck_') and not d.endswith('.egg-info') and os.path.join(adjusted_root, d) not in to_ignore]
-        if root_directory is None and ('setup.py' in files or 'setup.cfg' in files or 'pyproject.toml' in files):
-            root_directory = root
-            if 'pyproject.toml' in files:
-                with open(os.path.join(root, 'pyproject.toml'), 'rb') as fp:
-                    data = tomli.load(fp)
-                    if 'project' not in data:
-                        raise TerminalException("The pyproject.toml file did not contain a project section")
-                    if 'name' not in data['project']:
-                        raise TerminalException("The pyproject.toml file did not contain the package name")
-                    this_package_name = data['project']['name']
-                    if 'dependencies' in data['project'] and isinstance(data['project']['dependencies'], list):
-                        for dependency_string in data['project']['dependencies']:
-                            mm = re.search(r'(.*)(<=|>=|==|<|>)(.*)', dependency_string)
-                            if mm:
-                                dependencies[mm.group(1).strip()] = {'installed': False, 'operator': mm.group(2), 'version': mm.group(3).strip()}
-                            else:
-                                dependencies[dependency_string] = {'installed': False, 'operator': None, 'version': None}
-            if 'setup.py' in files:
-                with open(os.path.join(root, 'setup.py'), 'r', encoding='utf-8') as fp:
-                    setup_text = fp.read()
-                    m = re.search(r'setup\(.*\bname=(["\'])(.*?)(["\'])', setup_text)
-                    if m and m.group(1) == m.group(3):
-                        this_package_name = m.group(2).strip()
-                    m = re.search(r'setup\(.*install_requires=\[(.*?)\]', setup_text, flags=re.DOTALL)
-                    if m:
-                        for package_text in m.group(1).split(','):
-                            package_name = package_text.strip()
-                            if len(package_name) >= 3 and package_name[0] == package_name[-1] and package_name[0] in ("'", '"'):
-                                package_name = package_name[1:-1]
-                                mm = re.search(r'(.*)(<=|>=|==|<|>)(.*)', package_name)
-                                if mm:
-                                    dependencies[mm.group(1).strip()] = {'installed': False, 'operator': mm.group(2), 'version': mm.group(3).strip()}
-                                else:
-                                    dependencies[package_name] = {'installed': False, 'operator': None, 'version': None}
-        for the_file in files:
-            if the_file.endswith('~') or the_file.endswith('.pyc') or the_file.endswith('.swp') or the_file.startswith('#') or the_file.startswith('.#') or the_file.startswith('.flycheck_') or (the_file == '.gitignore' and root_directory == root) or os.path.join(adjusted_root, the_file) in to_ignore:
-                continue
-            if not has_python_files and the_file.endswith('.py') and not (the_file in ('setup.py', 'setup.cfg', 'pyproject.toml') and root == root_directory) and the_file != '__init__.py':
-                has_python_files = True
+    found_files = []
+    if file_index is not None:
+        root_directory = args.directory
+        this_package_name, dependencies = read_package_metadata(root_directory, [path for path in ('setup.py', 'setup.cfg', 'pyproject.toml') if os.path.isfile(os.path.join(root_directory, path))])
+        for relative_path in file_index.paths():
+            parts = relative_path.split('/')
+            found_files.append((os.path.join(args.directory, *parts[:-1]), parts[-1], relative_path))
+    else:
+        ignore_paths = relative_ignore_paths(args.directory, to_ignore)
+        install_ignore = read_install_ignore(args.directory)
+        for root, dirs, files in os.walk(args.directory, topdown=True):
+            relative_root = '/'.join(os.path.relpath(root, args.directory).split(os.sep))
+            relative_root = '' if relative_root == '.' else relative_root + '/'
+            dirs[:] = [d for d in dirs if not directory_is_excluded(d, relative_root + d, ignore_paths, install_ignore)]
+            if root_directory is None and ('setup.py' in files or 'setup.cfg' in files or 'pyproject.toml' in files):
+                root_directory = root
+                this_package_name, dependencies = read_package_metadata(root, files)
+            for the_file in files:
+                if file_is_excluded(the_file, relative_root + the_file, ignore_paths, install_ignore):
+                    continue
+                found_files.append((root, the_file, relative_root + the_file))
+    if args.manifest:
+        declared = declared_package_files(args.directory, [item[2] for item in found_files])
+        found_files = [item for item in found_files if item[2] in declared]
+    written_files = []
+    for root, the_file, relative_path in found_files:
+        file_path = os.path.join(root, the_file)
+        arcname = os.path.relpath(file_path, os.path.join(args.directory, '..'))
+        try:
             if args.watch:
-                checksum_is_same(os.path.join(root, the_file))
-            zf.write(os.path.join(root, the_file), os.path.relpath(os.path.join(root, the_file), os.path.join(args.directory, '..')))
+                # The checksum of what is installed is taken from the bytes in the archive, so a file saved while the archive is being built is not mistaken for installed.
+                write_and_remember(zf, file_path, arcname, compression_for_file(file_path, args.compression), args.compresslevel)
+            else:
+                zf.write(file_path, arcname, compress_type=compression_for_file(file_path, args.compression))
+        except FileNotFoundError:
+            # The file was deleted after it was listed.
+            if file_index is not None:
+                file_index.update(file_path, 'deleted', False)
+            continue
+        written_files.append(file_path)
+        if not has_python_files and the_file.endswith('.py') and not (the_file in ('setup.py', 'setup.cfg', 'pyproject.toml') and root == root_directory) and the_file != '__init__.py':
+            has_python_files = True
     zf.close()
     archive.seek(0)
+    interview_files = [file_path for file_path in written_files if is_interview_file(file_path)]
+    return {'archive': archive, 'entries': zf.infolist(), 'has_python_files': has_python_files, 'this_package_name': this_package_name, 'dependencies': dependencies, 'interview_files': interview_files}
+
+
+def is_interview_file(file_path):
+    return playground_folder_of(file_path) == 'questions' and os.path.splitext(file_path)[1].lower() in ('.yml', '.yaml')
+
+
+def interview_yaml_problems(content):
+    """Parses the contents of an interview file and returns a list of problems with its YAML."""
+    try:
+        text = content.decode('utf-8')
+    except UnicodeDecodeError as err:
+        return ["not valid UTF-8: " + str(err)]
+    # Interview files that start with "# use jinja" are only YAML after the server has rendered them.
+    if re.match(r'# use jinja\s*$', text.split('\n', 1)[0]):
+        return []
+    problems = []
+    try:
+        for index, document in enumerate(yaml.load_all(text, Loader=YAML_LOADER)):
+            if document is not None and not isinstance(document, dict):
+                problems.append(f"block {index + 1} is a {type(document).__name__}, not a dictionary")
+    except yaml.MarkedYAMLError as err:
+        location = f"line {err.problem_mark.line + 1}, column {err.problem_mark.column + 1}: " if err.problem_mark is not None else ''
+        problems.append(location + (err.context + ", " if err.context else '') + str(err.problem))
+    except yaml.YAMLError as err:
+        problems.append(str(err))
+    return problems
+
+
+def read_interview_file(file_path):
+    try:
+        with open(file_path, 'rb') as fp:
+            content = fp.read()
+    except FileNotFoundError:
+        return None
+    return hashlib.blake2b(content).hexdigest(), content
+
+
+def check_interview_files(file_paths):
+    """Checks the YAML of interview files and returns {file_path: problems} for the files that have problems.
+
+    Results are remembered by the hash of the file contents, so only
+    files that changed since they were last checked are parsed again.
+    """
+    global yaml_process_pool
+    contents = {}
+    for file_path, result in zip(file_paths, get_hash_executor().map(read_interview_file, file_paths)):
+        if result is not None:
+            contents[file_path] = result
+    results = {}
+    to_parse = {}
+    with yaml_check_lock:
+        for file_path, (digest, content) in contents.items():
+            if digest in yaml_checks:
+                yaml_checks.move_to_end(digest)
+                results[file_path] = yaml_checks[digest]
+            else:
+                to_parse[digest] = content
+    if len(to_parse) > 0:
+        parsed = None
+        if len(to_parse) > 1 and sum(len(content) for content in to_parse.values()) >= YAML_CHECK_PROCESS_BYTES:
+            try:
+                parsed = list(get_yaml_process_pool().map(interview_yaml_problems, to_parse.values()))
+            except (OSError, concurrent.futures.process.BrokenProcessPool):
+                yaml_process_pool = None
+                parsed = None
+        if parsed is None:
+            parsed = [interview_yaml_problems(content) for content in to_parse.values()]
+        with yaml_check_lock:
+            for digest, problems in zip(to_parse, parsed):
+                yaml_checks[digest] = problems
+                yaml_checks.move_to_end(digest)
+            while len(yaml_checks) > YAML_CHECK_CACHE_SIZE:
+                yaml_checks.popitem(last=False)
+        parsed_by_digest = dict(zip(to_parse, parsed))
+        for file_path, (digest, content) in contents.items():
+            if file_path not in results:
+                results[file_path] = parsed_by_digest[digest]
+    return {file_path: problems for file_path, problems in results.items() if len(problems) > 0}
+
+
+def report_invalid_interview_files(args, invalid, directory):
+    """Writes the problems found by check_interview_files(); returns True if the files should not be uploaded."""
+    if len(invalid) == 0:
+        return False
+    for file_path in sorted(invalid):
+        for problem in invalid[file_path]:
+            sys.stderr.write("Invalid YAML in " + os.path.relpath(file_path, directory) + ": " + problem + "\n")
+    if args.validate == 'error':
+        return True
+    sys.stderr.write("Uploading anyway because --validate is warn.\n")
+    return False
+
+
+def get_server_info(preflight):
+    try:
+        return preflight.result()
+    except Exception as err:
+        raise TerminalException("Unable to connect to server. " + str(err))
+
+
+def install_destination(args):
+    if args.playground:
+        return 'playground:' + (args.project or 'default')
+    return 'server'
+
+
+def do_install(args, apikey, apiurl, to_ignore, file_index=None, preflight=None):
+    with HistoryRecord('dainstall', apiurl, None, 'watch' if args.watch else ('playground' if args.playground else 'server')):
+        if preflight is None:
+            preflight = ServerPreflight(apiurl, apikey, args.playground)
+        build_start = time.time()
+        archive_info = build_archive(args, to_ignore, file_index)
+        build_end = time.time()
+        history_add_time('build', build_end - build_start)
+        package_name = archive_info['this_package_name'] or os.path.basename(os.path.abspath(args.directory))
+        history_set(package=package_name, archive_bytes=os.path.getsize(archive_info['archive'].name), files=len(archive_info['entries']))
+        if args.validate:
+            invalid = check_interview_files(archive_info['interview_files'])
+            if report_invalid_interview_files(args, invalid, args.directory):
+                raise TerminalException("Not installing because " + str(len(invalid)) + (" interview file has" if len(invalid) == 1 else " interview files have") + " invalid YAML.")
+        if args.archive_report:
+            write_archive_report(archive_info['entries'])
+        server_info = get_server_info(preflight)
+        saved = preflight.seconds_saved(build_end)
+        if saved >= 0.1:
+            sys.stdout.write(f"Contacted the server while building the archive, saving {saved:.1f} seconds.\n")
+            sys.stdout.flush()
+        else:
+            debug_log(args, f"Contacting the server while building the archive saved {saved:.3f} seconds")
+        if args.nolock:
+            return install_archive(args, apikey, apiurl, archive_info, server_info)
+        with InstallCoordinator(apiurl, package_name, install_destination(args) + ' from ' + os.path.abspath(args.directory)) as coordinator:
+            history_add_time('lock', coordinator.wait_time)
+            if coordinator.superseded_by is not None:
+                raise InstallSuperseded()
+            if coordinator.wait_time >= LOCK_POLL_INTERVAL:
+                # Another install finished in the meantime, so what is installed may have changed.
+                server_info = get_server_info(ServerPreflight(apiurl, apikey, args.playground))
+            return install_archive(args, apikey, apiurl, archive_info, server_info)
+
+
+def restart_decision(args, archive_info, installed_packages):
+    """Returns whether installing the archive should restart the server, and why.
+
+    If the answer depends on the packages installed on the server and
+    installed_packages is None, the answer is None.
+    """
+    has_python_files = archive_info['has_python_files']
+    this_package_name = archive_info['this_package_name']
+    dependencies = archive_info['dependencies']
     if args.norestart:
-        should_restart = False
-    elif args.force_restart or has_python_files:
-        should_restart = True
-    elif len(dependencies) > 0 or this_package_name:
-        r = requests.get(apiurl + '/api/package', headers={'X-API-Key': apikey}, timeout=50)
-        if r.status_code != 200:
-            raise TerminalException("/api/package returned " + str(r.status_code) + ": " + r.text)
-        installed_packages = r.json()
+        return False, 'not requested'
+    if args.force_restart:
+        return True, '--force-restart'
+    if has_python_files:
+        return True, 'Python modules'
+    if len(dependencies) > 0 or this_package_name:
+        if installed_packages is None:
+            return None, 'depends on the packages installed on the server'
         already_installed = False
         for package_info in installed_packages:
             package_info['alt_name'] = re.sub('^docassemble\.', 'docassemble-', package_info['name'])
@@ -712,26 +2784,27 @@ def do_install(args, apikey, apiurl, to_ignore):
             if this_package_name and this_package_name in (package_info['name'], package_info['alt_name']):
                 already_installed = True
         should_restart = bool((not already_installed and len(dependencies) > 0) or not all(item['installed'] for item in dependencies.values()))
-    else:
-        should_restart = True
+        return should_restart, 'dependencies not installed' if should_restart else 'dependencies already installed'
+    return True, 'no package metadata'
+
+
+def install_archive(args, apikey, apiurl, archive_info, server_info):
+    archive = archive_info['archive']
+    should_restart, restart_reason = restart_decision(args, archive_info, server_info['packages'])
+    history_set(restart=should_restart, restart_reason=restart_reason)
     data = {}
     if not should_restart:
         data['restart'] = '0'
+    archive_name = os.path.basename(os.path.abspath(args.directory)) + '.zip'
     if args.playground:
         if args.project and args.project != 'default':
             data['project'] = args.project
-        project_endpoint = apiurl + '/api/playground/project'
-        project_list = requests.get(project_endpoint, headers={'X-API-Key': apikey}, timeout=50)
-        if project_list.status_code == 200:
-            if not args.project in project_list:
-                try:
-                    requests.post(project_endpoint, data={'project': args.project}, headers={'X-API-Key': apikey}, timeout=50)
-                except:
-                    raise TerminalException("create project POST failed")
-        else:
-            sys.stdout.write("\n")
-            raise TerminalException("playground list of projects GET returned " + str(project_list.status_code) + ": " + project_list.text)
-        r = requests.post(apiurl + '/api/playground_install', data=data, files={'file': archive}, headers={'X-API-Key': apikey}, timeout=50)
+        if 'project' in data and data['project'] not in server_info['projects']:
+            try:
+                requests.post(apiurl + '/api/playground/project', data={'project': data['project']}, headers={'X-API-Key': apikey}, timeout=50)
+            except:
+                raise TerminalException("create project POST failed")
+        r = post_with_retries(apiurl + '/api/playground_install', data, 'file', archive, archive_name, apikey, "Upload of " + archive_name, False)
         if r.status_code == 400:
             try:
                 error_message = r.json()
@@ -742,8 +2815,7 @@ def do_install(args, apikey, apiurl, to_ignore):
             r = requests.post(apiurl + '/api/playground/project', data={'project': data['project']}, headers={'X-API-Key': apikey}, timeout=50)
             if r.status_code != 204:
                 raise TerminalException("needed to create playground project but POST to api/playground/project returned " + str(r.status_code) + ": " + r.text)
-            archive.seek(0)
-            r = requests.post(apiurl + '/api/playground_install', data=data, files={'file': archive}, headers={'X-API-Key': apikey}, timeout=50)
+            r = post_with_retries(apiurl + '/api/playground_install', data, 'file', archive, archive_name, apikey, "Upload of " + archive_name, False)
         if r.status_code == 200:
             try:
                 info = r.json()
@@ -762,7 +2834,7 @@ def do_install(args, apikey, apiurl, to_ignore):
         else:
             raise TerminalException("\nInstall failed\n")
     else:
-        r = requests.post(apiurl + '/api/package', data=data, files={'zip': archive}, headers={'X-API-Key': apikey}, timeout=50)
+        r = post_with_retries(apiurl + '/api/package', data, 'zip', archive, archive_name, apikey, "Upload of " + archive_name, False)
         if r.status_code != 200:
             raise TerminalException("package POST returned " + str(r.status_code) + ": " + r.text)
         info = r.json()
@@ -773,6 +2845,215 @@ def do_install(args, apikey, apiurl, to_ignore):
             r = requests.post(apiurl + '/api/clear_cache', headers={'X-API-Key': apikey}, timeout=50)
             if r.status_code != 204:
                 raise TerminalException("clear_cache returned " + str(r.status_code) + ": " + r.text)
+    return should_restart
+
+
+def git_changed_files(directory):
+    """Returns the files under directory that differ from HEAD, according to git, as (path, event type) pairs."""
+    top = git_output(['rev-parse', '--show-toplevel'], directory)
+    output = git_output(['status', '--porcelain=v2', '-z', '--untracked-files=all', '--', '.'], directory)
+    entries = output.split('\0')
+    changes = []
+    index = 0
+    while index < len(entries):
+        entry = entries[index]
+        index += 1
+        if entry.startswith('1 '):
+            fields = entry.split(' ', 8)
+            changes.append((fields[8], 'deleted' if 'D' in fields[1] else ('created' if fields[1][0] == 'A' else 'modified')))
+        elif entry.startswith('2 '):
+            fields = entry.split(' ', 9)
+            if fields[1][0] == 'R' and index < len(entries):
+                changes.append((entries[index], 'deleted'))
+            index += 1
+            changes.append((fields[9], 'created'))
+        elif entry.startswith('u '):
+            changes.append((entry.split(' ', 10)[10], 'modified'))
+        elif entry.startswith('? '):
+            changes.append((entry[2:], 'created'))
+    return [(os.path.join(top, *path.split('/')), event_type) for path, event_type in changes]
+
+
+def plan_watch_batch(args, file_index, archive_restart):
+    """Predicts what dainstall --watch would do with the uncommitted changes after its initial install."""
+    try:
+        changed_files = git_changed_files(args.directory)
+    except TerminalException as err:
+        return {'changes': None, 'note': "Unable to list changed files with git: " + str(err)}
+    changes = []
+    for path, event_type in changed_files:
+        relative_path = file_index.relative_path(path)
+        if relative_path is not None and not file_index.is_excluded(relative_path, False) and (event_type == 'deleted' or file_index.stat(path) is not None):
+            changes.append({'event_type': event_type, 'is_directory': False, 'src_path': path})
+    plan = {'changes': [{'path': file_index.relative_path(event['src_path']), 'action': event['event_type']} for event in changes]}
+    if len(changes) == 0:
+        plan.update({'mode': None, 'restart': False, 'note': "There are no uncommitted changes, so there would be nothing to install."})
+        return plan
+    restart = watch_batch_restart(args, changes, args.norestart, False)
+    if args.playground and len(changes) < EVENT_STORM_COUNT:
+        todo_by_folder = classify_playground_changes(args, changes)
+        if todo_by_folder is not None:
+            jobs, background_jobs = order_playground_uploads(todo_by_folder, file_index)
+            plan.update({'mode': 'uploads', 'restart': len(todo_by_folder['modules']) > 0, 'requests': len(jobs) + len(background_jobs), 'uploads': [{'path': file_index.relative_path(job['file_path']), 'folder': job['folder'], 'action': job['action'], 'bytes': job['size'], 'background': job['background']} for job in jobs + background_jobs]})
+            return plan
+    # A full install in --watch mode restarts the server only if the batch calls for a restart and the archive does.
+    plan.update({'mode': 'full', 'restart': archive_restart if restart else False})
+    return plan
+
+
+def plan_install(args, apikey, apiurl, to_ignore, preflight):
+    """Works out what installing the package would do, without changing anything on the server."""
+    build_start = time.time()
+    archive_info = build_archive(args, to_ignore)
+    build_seconds = time.time() - build_start
+    file_index = FileIndex(args.directory, to_ignore, read_install_ignore(args.directory))
+    try:
+        server_info = preflight.result()
+        server_error = None
+    except Exception as err:
+        server_info = None
+        server_error = "Unable to connect to server. " + str(err)
+    should_restart, restart_reason = restart_decision(args, archive_info, server_info['packages'] if server_info is not None else None)
+    archive_name = os.path.basename(os.path.abspath(args.directory)) + '.zip'
+    fields = {} if should_restart is not False else {'restart': '0'}
+    planned_requests = [{'method': 'GET', 'path': '/api/package', 'purpose': "check the API key and list the installed packages"}]
+    if args.playground:
+        project = args.project if args.project and args.project != 'default' else None
+        if project is not None:
+            fields['project'] = project
+        planned_requests.append({'method': 'GET', 'path': '/api/playground/project', 'purpose': "list the Playground projects"})
+        if project is not None and (server_info is None or project not in server_info['projects']):
+            planned_requests.append({'method': 'POST', 'path': '/api/playground/project', 'purpose': "create the project " + project})
+        upload_bytes = len(MultipartUpload(fields, 'file', archive_info['archive'], archive_name, archive_name))
+        planned_requests.append({'method': 'POST', 'path': '/api/playground_install', 'purpose': "upload the archive", 'bytes': upload_bytes})
+        if should_restart is not False:
+            planned_requests.append({'method': 'GET', 'path': '/api/restart_status', 'purpose': "wait for the server to restart", 'repeated': True})
+    else:
+        upload_bytes = len(MultipartUpload(fields, 'zip', archive_info['archive'], archive_name, archive_name))
+        planned_requests.append({'method': 'POST', 'path': '/api/package', 'purpose': "upload the archive", 'bytes': upload_bytes})
+        planned_requests.append({'method': 'GET', 'path': '/api/package_update_status', 'purpose': "wait for the package to install", 'repeated': True})
+        if should_restart is not True:
+            planned_requests.append({'method': 'POST', 'path': '/api/clear_cache', 'purpose': "clear the cache instead of restarting"})
+    entries = archive_info['entries']
+    invalid = check_interview_files(archive_info['interview_files']) if args.validate else {}
+    return {
+        'package': archive_info['this_package_name'] or os.path.basename(os.path.abspath(args.directory)),
+        'server': name_from_url(apiurl),
+        'target': 'playground' if args.playground else 'server',
+        'project': args.project if args.playground else None,
+        'server_error': server_error,
+        'archive': {'files': [{'path': info.filename, 'bytes': info.file_size, 'compressed_bytes': info.compress_size, 'compression': 'stored' if info.compress_type == zipfile.ZIP_STORED else 'deflated'} for info in entries], 'file_count': len(entries), 'bytes': sum(info.file_size for info in entries), 'compressed_bytes': sum(info.compress_size for info in entries), 'upload_bytes': upload_bytes, 'build_seconds': round(build_seconds, 3)},
+        'invalid_yaml': {os.path.relpath(file_path, args.directory): problems for file_path, problems in sorted(invalid.items())} if args.validate else None,
+        'restart': should_restart,
+        'restart_reason': restart_reason,
+        'requests': planned_requests,
+        'watch': plan_watch_batch(args, file_index, should_restart),
+    }
+
+
+def write_plan(plan, out=None):
+    if out is None:
+        out = sys.stdout
+    archive = plan['archive']
+    out.write("Plan for installing " + plan['package'] + " on " + plan['server'] + (" into the Playground" + (" (project " + plan['project'] + ")" if plan['project'] else '') if plan['target'] == 'playground' else '') + "\n")
+    if plan['server_error']:
+        out.write("  " + plan['server_error'] + "\n")
+    out.write(f"\nArchive: {archive['file_count']} files, {format_bytes(archive['compressed_bytes'])} compressed from {format_bytes(archive['bytes'])}; upload of {format_bytes(archive['upload_bytes'])} (built in {archive['build_seconds']:.2f} seconds)\n")
+    for item in archive['files']:
+        out.write(f"  {format_bytes(item['compressed_bytes']):>10} {item['compression']:<8} {item['path']}\n")
+    if plan['invalid_yaml']:
+        out.write(f"\nInvalid YAML in {len(plan['invalid_yaml'])} interview " + ('file' if len(plan['invalid_yaml']) == 1 else 'files') + ":\n")
+        for path, problems in plan['invalid_yaml'].items():
+            for problem in problems:
+                out.write("  " + path + ": " + problem.replace("\n", "\n    ") + "\n")
+    out.write("\nRestart: " + {True: 'yes', False: 'no', None: 'unknown'}[plan['restart']] + " (" + plan['restart_reason'] + ")\n")
+    out.write(f"\nRequests ({len(plan['requests'])}, plus repeated status checks while the server works):\n")
+    for item in plan['requests']:
+        out.write("  " + item['method'] + " " + item['path'] + " to " + item['purpose'] + (f" ({format_bytes(item['bytes'])})" if 'bytes' in item else '') + (", repeated until done" if item.get('repeated') else '') + "\n")
+    watch_plan = plan['watch']
+    out.write("\nWith --watch" + (" --playground" if plan['target'] == 'playground' else '') + ", after the initial install, the uncommitted changes would be handled as follows:\n")
+    if watch_plan['changes'] is None or len(watch_plan['changes']) == 0:
+        out.write("  " + watch_plan['note'] + "\n")
+    elif watch_plan['mode'] == 'uploads':
+        for item in watch_plan['uploads']:
+            out.write("  " + ('delete' if item['action'] == 'delete' else 'upload') + " " + item['path'] + " (" + item['folder'] + (", " + format_bytes(item['bytes']) + " in the background" if item['background'] else '') + ")\n")
+        out.write(f"  {watch_plan['requests']} single-file requests; restart: " + ('yes' if watch_plan['restart'] else 'no') + "\n")
+    else:
+        out.write(f"  {len(watch_plan['changes'])} changed files would be installed with a full install; restart: " + {True: 'yes', False: 'no', None: 'unknown'}[watch_plan['restart']] + "\n")
+    out.flush()
+
+
+def git_output(arguments, directory):
+    try:
+        process = subprocess.run(['git'] + arguments, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, cwd=directory, check=False, timeout=GIT_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as err:
+        raise TerminalException("Unable to run git " + arguments[0] + ": " + str(err))
+    if process.returncode != 0:
+        raise TerminalException("git " + arguments[0] + " failed: " + process.stderr.strip())
+    return process.stdout.strip()
+
+
+def verify_remote_ref(github_url, branch, directory):
+    if shutil.which("git") is None:
+        raise TerminalException("git is needed to check that " + github_url + " matches your local HEAD. Use --skip-ref-check to install without checking.")
+    try:
+        local_commit = git_output(['rev-parse', 'HEAD'], directory)
+    except TerminalException as err:
+        raise TerminalException(str(err) + "\nRun dainstall from your local clone of " + github_url + ", pass its directory, or use --skip-ref-check.")
+    ref = 'refs/heads/' + branch if branch else 'HEAD'
+    remote_output = git_output(['ls-remote', github_url, ref], directory)
+    remote_commit = None
+    for line in remote_output.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[1] == ref:
+            remote_commit = parts[0]
+            break
+    if remote_commit is None:
+        raise TerminalException(github_url + " does not have " + (("a branch called " + branch) if branch else "a default branch") + ".")
+    if remote_commit != local_commit:
+        raise TerminalException((branch or "The default branch") + " of " + github_url + " is at " + remote_commit[:12] + ", but your local HEAD is at " + local_commit[:12] + ". Push your changes first, or use --skip-ref-check to install what is on the remote.")
+    sys.stdout.write("Remote " + ref + " matches local HEAD " + local_commit[:12] + ".\n")
+    sys.stdout.flush()
+
+
+def do_remote_install(args, apikey, apiurl):
+    data = {}
+    if args.github_url:
+        data['github_url'] = args.github_url
+        if args.branch:
+            data['branch'] = args.branch
+        package_name = re.sub(r'^docassemble-', 'docassemble.', re.sub(r'\.git$', '', args.github_url.rstrip('/').split('/')[-1]))
+    else:
+        data['pip'] = args.pip
+        package_name = re.split(r'[<>=!~\[; ]', args.pip, maxsplit=1)[0]
+    if args.norestart:
+        data['restart'] = '0'
+    with HistoryRecord('dainstall', apiurl, package_name, 'github' if args.github_url else 'pip'):
+        history_set(restart=not args.norestart, restart_reason='not requested' if args.norestart else 'server install')
+        if args.nolock:
+            return install_remote(args, apikey, apiurl, data)
+        with InstallCoordinator(apiurl, package_name, 'server from ' + (args.github_url + ('@' + args.branch if args.branch else '') if args.github_url else args.pip)) as coordinator:
+            history_add_time('lock', coordinator.wait_time)
+            if coordinator.superseded_by is not None:
+                raise InstallSuperseded()
+            return install_remote(args, apikey, apiurl, data)
+
+
+def install_remote(args, apikey, apiurl, data):
+    r = requests.post(apiurl + '/api/package', data=data, headers={'X-API-Key': apikey}, timeout=UPLOAD_TIMEOUT)
+    if r.status_code != 200:
+        raise TerminalException("package POST returned " + str(r.status_code) + ": " + r.text)
+    info = r.json()
+    task_id = info['task_id']
+    if wait_for_server(False, task_id, apikey, apiurl):
+        sys.stdout.write("\nInstalled.\n")
+    else:
+        raise TerminalException("\nInstall failed\n")
+    if args.norestart:
+        r = requests.post(apiurl + '/api/clear_cache', headers={'X-API-Key': apikey}, timeout=50)
+        if r.status_code != 204:
+            raise TerminalException("clear_cache returned " + str(r.status_code) + ": " + r.text)
+    return not args.norestart
 
 
 def dacreate():
@@ -1024,6 +3305,175 @@ def find_package_data(where='.', package='', exclude=standard_exclude, exclude_d
         the_file.write("__version__ = " + repr(version) + "\n")
     return(0)
 
+def download_package(args, apikey, apiurl, package_name, archive):
+    if args.playground:
+        params = {'folder': 'packages', 'filename': package_name}
+        if args.project:
+            params['project'] = args.project
+        try:
+            with requests.get(apiurl + '/api/playground', params=params, stream=True, timeout=60, headers={'X-API-Key': apikey}) as r:
+                if r.status_code == 404:
+                    raise TerminalException("Package not found.")
+                r.raise_for_status()
+                with open(archive.name, 'wb') as fp:
+                    for chunk in r.iter_content(8192):
+                        fp.write(chunk)
+        except requests.exceptions.HTTPError as err:
+            raise TerminalException("Error downloading package: " + str(err))
+    else:
+        zip_file_number = None
+        found = False
+        try:
+            response = requests.get(apiurl + '/api/package', headers={'X-API-Key': apikey}, timeout=50)
+            assert response.status_code == 200
+        except:
+            raise TerminalException("Unable to connect to server.")
+        for item in response.json():
+            if item['name'] == package_name:
+                found = True
+                if 'zip_file_number' in item:
+                    zip_file_number = item['zip_file_number']
+                break
+        if found is False:
+            raise TerminalException("Package not installed.")
+        if zip_file_number is None:
+            raise TerminalException("Package installed but is not downloadable.")
+        try:
+            with requests.get(apiurl + '/api/file/' + str(zip_file_number), stream=True, timeout=60, headers={'X-API-Key': apikey}) as r:
+                r.raise_for_status()
+                with open(archive.name, 'wb') as fp:
+                    for chunk in r.iter_content(8192):
+                        fp.write(chunk)
+        except requests.exceptions.HTTPError as err:
+            raise TerminalException("Error downloading package: " + str(err))
+
+
+def playground_local_path(package_file_name, package_name, folder, filename):
+    package_directory = os.path.join(package_file_name, *package_name.split('.'))
+    if folder == 'modules':
+        return os.path.join(package_directory, filename)
+    return os.path.join(package_directory, 'data', folder, filename)
+
+
+def read_sync_manifest(path, apiurl, project):
+    try:
+        with open(path, 'r', encoding='utf-8') as fp:
+            manifest = json.load(fp)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as err:
+        sys.stderr.write("Ignoring " + path + " because it could not be read: " + str(err) + "\n")
+        return {}
+    # Validators from another server or project say nothing about these files.
+    if not isinstance(manifest, dict) or manifest.get('server') != apiurl or manifest.get('project') != project or not isinstance(manifest.get('files'), dict):
+        return {}
+    return manifest['files']
+
+
+def write_file_atomically(path, content):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(content)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def list_playground_folder(session, apiurl, apikey, folder, project):
+    params = {'folder': folder}
+    if project:
+        params['project'] = project
+    try:
+        r = session.get(apiurl + '/api/playground', params=params, headers={'X-API-Key': apikey}, timeout=60)
+    except requests.exceptions.RequestException as err:
+        raise TerminalException("Unable to list the " + folder + " folder of the Playground: " + str(err))
+    if r.status_code != 200:
+        raise TerminalException("Unable to list the " + folder + " folder of the Playground: " + r.text)
+    return r.json()
+
+
+def fetch_playground_file(session, args, apikey, apiurl, key, local_path, entry):
+    """Downloads one Playground file for dadownload --sync, unless the copy from the last sync is still current."""
+    folder, filename = key.split('/', 1)
+    local_digest = file_digest(local_path) if os.path.isfile(local_path) else None
+    headers = {'X-API-Key': apikey}
+    if entry is not None and local_digest is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    params = {'folder': folder, 'filename': filename}
+    if args.project:
+        params['project'] = args.project
+    try:
+        r = session.get(apiurl + '/api/playground', params=params, headers=headers, timeout=60)
+    except requests.exceptions.RequestException as err:
+        raise TerminalException("Unable to download " + key + " from the Playground: " + str(err))
+    if r.status_code == 304:
+        return 'unchanged', entry, 0
+    if r.status_code == 404:
+        return 'missing', None, 0
+    if r.status_code != 200:
+        raise TerminalException("Unable to download " + key + " from the Playground: " + r.text)
+    digest = hashlib.blake2b(r.content).hexdigest()
+    new_entry = {'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified'), 'digest': digest}
+    if local_digest == digest:
+        return 'unchanged', new_entry, len(r.content)
+    # A file that was edited here since it was downloaded, or that was never downloaded, is only replaced with --overwrite.
+    if local_digest is not None and not args.overwrite and (entry is None or entry.get('digest') != local_digest):
+        return 'conflict', entry, len(r.content)
+    write_file_atomically(local_path, r.content)
+    return 'downloaded', new_entry, len(r.content)
+
+
+def sync_playground(args, apikey, apiurl, package_name, package_file_name):
+    """Brings the Playground files of a project up to date in the package directory.
+
+    Each Playground folder is listed, and only the files that are new,
+    or that changed according to the ETag and Last-Modified validators
+    recorded in the manifest of the previous sync, are downloaded.
+    Files that were deleted from the Playground are deleted here, unless
+    they were changed here since the last sync.
+    """
+    project = args.project or 'default'
+    manifest_path = os.path.join(package_file_name, SYNC_MANIFEST_FILE)
+    entries = read_sync_manifest(manifest_path, apiurl, project)
+    summary = {'downloaded': 0, 'unchanged': 0, 'deleted': 0, 'bytes': 0, 'conflicts': []}
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=SYNC_WORKERS)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SYNC_WORKERS) as executor:
+            listings = list(executor.map(lambda folder: list_playground_folder(session, apiurl, apikey, folder, args.project), UPLOAD_LANE_ORDER))
+            remote_keys = [folder + '/' + filename for folder, filenames in zip(UPLOAD_LANE_ORDER, listings) for filename in filenames]
+            local_paths = {key: playground_local_path(package_file_name, package_name, *key.split('/', 1)) for key in set(remote_keys) | set(entries)}
+            results = executor.map(lambda key: fetch_playground_file(session, args, apikey, apiurl, key, local_paths[key], entries.get(key)), remote_keys)
+            new_entries = {}
+            for key, (status, entry, size) in zip(remote_keys, results):
+                summary['bytes'] += size
+                if status == 'conflict':
+                    summary['conflicts'].append(local_paths[key])
+                elif status in ('downloaded', 'unchanged'):
+                    summary[status] += 1
+                if entry is not None:
+                    new_entries[key] = entry
+    for key in sorted(set(entries) - set(remote_keys)):
+        local_path = local_paths[key]
+        if not os.path.isfile(local_path):
+            continue
+        if file_digest(local_path) == entries[key].get('digest'):
+            os.remove(local_path)
+            summary['deleted'] += 1
+        else:
+            sys.stderr.write("Keeping " + local_path + ", which was deleted from the Playground but changed here since the last sync.\n")
+    write_file_atomically(manifest_path, json.dumps({'server': apiurl, 'project': project, 'files': new_entries}, indent=1, sort_keys=True).encode('utf-8'))
+    return summary
+
+
 def dadownload():
     dotfile = os.path.join(os.path.expanduser('~'), '.docassemblecli')
     parser = argparse.ArgumentParser()
@@ -1034,11 +3484,14 @@ def dadownload():
     parser.add_argument("--server", help="use a particular server from the .docassemblecli config file")
     parser.add_argument("--playground", help="download from the Playground", action="store_true")
     parser.add_argument("--project", help="download from a specific project in the Playground")
+    parser.add_argument("--sync", help="with --playground, download only the files in the Playground folders of the project that are new or changed since the last --sync, instead of the whole package", action="store_true")
     parser.add_argument("--add", help="add another server to the .docassemblecli config file", action="store_true")
     parser.add_argument("--noconfig", help="do not use the .docassemblecli config file", action="store_true")
     args = parser.parse_args()
     if args.project and not args.playground:
         return("The --project option can only be used with --playground.")
+    if args.sync and not args.playground:
+        return("The --sync option can only be used with --playground.")
     if not args.add:
         if args.package is None:
             parser.print_help()
@@ -1116,47 +3569,28 @@ def dadownload():
     if not package_name.startswith('docassemble.'):
         package_name = 'docassemble.' + package_name
     package_file_name = re.sub(r'docassemble\.', 'docassemble-', package_name)
-    archive = tempfile.NamedTemporaryFile(suffix=".zip")
-    if args.playground:
-        params = {'folder': 'packages', 'filename': package_name}
-        if args.project:
-            params['project'] = args.project
-        try:
-            with requests.get(apiurl + '/api/playground', params=params, stream=True, timeout=60, headers={'X-API-Key': apikey}) as r:
-                if r.status_code == 404:
-                    return("Package not found.")
-                r.raise_for_status()
-                with open(archive.name, 'wb') as fp:
-                    for chunk in r.iter_content(8192):
-                        fp.write(chunk)
-        except requests.exceptions.HTTPError as err:
-            return("Error downloading package: " + str(err))
-    else:
-        zip_file_number = None
-        found = False
-        try:
-            response = requests.get(apiurl + '/api/package', headers={'X-API-Key': apikey}, timeout=50)
-            assert response.status_code == 200
-        except:
-            return("Unable to connect to server.")
-        for item in response.json():
-            if item['name'] == package_name:
-                found = True
-                if 'zip_file_number' in item:
-                    zip_file_number = item['zip_file_number']
-                break
-        if found is False:
-            return("Package not installed.")
-        if zip_file_number is None:
-            return("Package installed but is not downloadable.")
+    if args.sync:
         try:
-            with requests.get(apiurl + '/api/file/' + str(zip_file_number), stream=True, timeout=60, headers={'X-API-Key': apikey}) as r:
-                r.raise_for_status()
-                with open(archive.name, 'wb') as fp:
-                    for chunk in r.iter_content(8192):
-                        fp.write(chunk)
-        except requests.exceptions.HTTPError as err:
-            sys.exit("Error downloading package: " + str(err))
+            with HistoryRecord('dadownload', apiurl, package_name, 'sync'):
+                download_start = time.time()
+                summary = sync_playground(args, apikey, apiurl, package_name, package_file_name)
+                history_add_time('transfer', time.time() - download_start)
+                history_set(archive_bytes=summary['bytes'], files=summary['downloaded'])
+        except TerminalException as err:
+            return(str(err))
+        print(f"Synced {package_file_name} with the Playground: {summary['downloaded']} downloaded, {summary['unchanged']} unchanged, {summary['deleted']} deleted ({format_bytes(summary['bytes'])} transferred).")
+        if len(summary['conflicts']) > 0:
+            return(f"Not overwriting {len(summary['conflicts'])} " + ('file' if len(summary['conflicts']) == 1 else 'files') + " that changed here since the last sync (" + ", ".join(summary['conflicts']) + "). Use --overwrite if you want to overwrite them.")
+        return(0)
+    archive = tempfile.NamedTemporaryFile(suffix=".zip")
+    try:
+        with HistoryRecord('dadownload', apiurl, package_name, 'playground' if args.playground else 'server'):
+            download_start = time.time()
+            download_package(args, apikey, apiurl, package_name, archive)
+            history_add_time('transfer', time.time() - download_start)
+            history_set(archive_bytes=os.path.getsize(archive.name))
+    except TerminalException as err:
+        return(str(err))
     with zipfile.ZipFile(archive.name, mode='r') as zf:
         if not args.overwrite:
             for file_info in zf.infolist():
@@ -1171,3 +3605,110 @@ def dadownload():
                 print(f"Error extracting '{file_path}': {e}")
     print(f"Unpacked {package_file_name}.")
     return(0)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if len(ordered) == 0:
+        return None
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    if seconds < 10:
+        return f"{seconds:.2f}s"
+    return f"{seconds:.1f}s"
+
+
+def summarize_runs(runs, recent):
+    summary = {'runs': len(runs), 'outcomes': dict(collections.Counter(run['outcome'] for run in runs)), 'restarts': sum(1 for run in runs if run['restart']), 'restart_reasons': dict(collections.Counter(run['restart_reason'] for run in runs if run['restart_reason'])), 'first': runs[0]['started'], 'last': runs[-1]['started'], 'phases': {}}
+    succeeded = [run for run in runs if run['outcome'] == 'success']
+    for phase in HISTORY_PHASES + ['total']:
+        values = [run[phase + '_seconds'] for run in succeeded if run[phase + '_seconds'] is not None]
+        if len(values) > 0:
+            summary['phases'][phase] = {'p50': percentile(values, 0.5), 'p90': percentile(values, 0.9), 'p99': percentile(values, 0.99), 'max': max(values)}
+    sizes = [run['archive_bytes'] for run in runs if run['archive_bytes'] is not None]
+    if len(sizes) > 0:
+        summary['archive_bytes'] = {'p50': percentile(sizes, 0.5), 'max': max(sizes)}
+    totals = [run['total_seconds'] for run in succeeded]
+    if len(totals) > recent:
+        recent_median = percentile(totals[-recent:], 0.5)
+        earlier_median = percentile(totals[:-recent], 0.5)
+        change = (recent_median - earlier_median) / earlier_median if earlier_median > 0 else 0.0
+        summary['trend'] = {'recent_runs': recent, 'recent_p50': recent_median, 'earlier_runs': len(totals) - recent, 'earlier_p50': earlier_median, 'change': change, 'regression': change > STATS_REGRESSION}
+    return summary
+
+
+def write_stats(groups, out=None):
+    if out is None:
+        out = sys.stdout
+    for group in groups:
+        summary = group['summary']
+        out.write(group['command'] + " " + (group['package'] or '(unknown package)') + " on " + group['server'] + " (" + group['mode'] + ")\n")
+        outcomes = ", ".join(f"{count} {outcome}" for outcome, count in sorted(summary['outcomes'].items()))
+        out.write(f"  {summary['runs']} runs from {datetime.datetime.fromtimestamp(summary['first']):%Y-%m-%d %H:%M} to {datetime.datetime.fromtimestamp(summary['last']):%Y-%m-%d %H:%M}: {outcomes}\n")
+        for phase in HISTORY_PHASES + ['total']:
+            if phase in summary['phases']:
+                values = summary['phases'][phase]
+                out.write(f"  {phase:<9} p50 {format_seconds(values['p50']):>8}  p90 {format_seconds(values['p90']):>8}  p99 {format_seconds(values['p99']):>8}  max {format_seconds(values['max']):>8}\n")
+        if 'archive_bytes' in summary:
+            out.write(f"  {'archive':<9} p50 {format_bytes(summary['archive_bytes']['p50']):>8}  max {format_bytes(summary['archive_bytes']['max']):>8}\n")
+        out.write(f"  restarted {summary['restarts']} of {summary['runs']} times")
+        if len(summary['restart_reasons']) > 0:
+            out.write(" (" + ", ".join(f"{reason}: {count}" for reason, count in sorted(summary['restart_reasons'].items(), key=lambda item: -item[1])) + ")")
+        out.write("\n")
+        if 'trend' in summary:
+            trend = summary['trend']
+            out.write(f"  trend: median of last {trend['recent_runs']} successful runs {format_seconds(trend['recent_p50'])} versus {format_seconds(trend['earlier_p50'])} for the {trend['earlier_runs']} before ({trend['change']:+.0%})" + (", slower than before\n" if trend['regression'] else "\n"))
+        out.write("\n")
+    out.flush()
+
+
+def dastats():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server", help="only include runs against this server (e.g., da.example.com)")
+    parser.add_argument("--package", help="only include runs for this package")
+    parser.add_argument("--command", help="only include runs of this command", choices=['dainstall', 'dauninstall', 'dadownload'])
+    parser.add_argument("--days", help="only include runs from the last DAYS days", type=float)
+    parser.add_argument("--recent", help=f"number of most recent runs to compare against earlier runs when reporting trends (default: {STATS_RECENT})", type=int, default=STATS_RECENT)
+    parser.add_argument("--format", help="output format (default: text)", choices=['text', 'json'], default='text')
+    args = parser.parse_args()
+    if args.recent < 1:
+        return("The --recent option must be at least 1.")
+    path = history_path()
+    if path is None:
+        return("Recording of history is turned off by the DOCASSEMBLECLI_HISTORY environment variable.")
+    if not os.path.isfile(path):
+        return("No history has been recorded yet in " + path + ".")
+    conditions = []
+    parameters = []
+    for column, value in (('server', args.server), ('package', history_package_name(args.package)), ('command', args.command)):
+        if value:
+            conditions.append(column + " = ?")
+            parameters.append(value)
+    if args.days is not None:
+        conditions.append("started >= ?")
+        parameters.append(time.time() - args.days * 86400)
+    try:
+        conn = open_history(path)
+        conn.row_factory = sqlite3.Row
+        try:
+            rows = conn.execute("SELECT * FROM runs" + (" WHERE " + " AND ".join(conditions) if len(conditions) > 0 else "") + " ORDER BY started", parameters).fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error as err:
+        return("Unable to read " + path + ": " + str(err))
+    runs_by_group = collections.OrderedDict()
+    for row in rows:
+        runs_by_group.setdefault((row['command'], row['server'], row['package'], row['mode']), []).append(dict(row))
+    groups = [{'command': command, 'server': server, 'package': package, 'mode': mode, 'summary': summarize_runs(runs, args.recent)} for (command, server, package, mode), runs in sorted(runs_by_group.items(), key=lambda item: -item[1][-1]['started'])]
+    if args.format == 'json':
+        json.dump(groups, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    elif len(groups) == 0:
+        sys.stdout.write("No runs match.\n")
+    else:
+        write_stats(groups)
+    return(0)